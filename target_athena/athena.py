@@ -1,7 +1,8 @@
 import os
-import singer
 from logging import Logger
-from pyathena import connect
+
+from target_athena import bucketing
+from target_athena import retry
 
 
 def create_client(config, logger: Logger):
@@ -15,6 +16,10 @@ def create_client(config, logger: Logger):
         cursor: athena client object
     """
 
+    from botocore.config import Config
+    from pyathena import connect  # deferred: pyathena pulls in boto3
+    from pyathena.util import RetryConfig
+
     logger.info("Attempting to create Athena session")
 
     # Get the required parameters from config file and/or environment variables
@@ -32,6 +37,13 @@ def create_client(config, logger: Logger):
     s3_staging_dir = config.get("s3_staging_dir") or os.environ.get("S3_STAGING_DIR")
     logger.info(f"Using Athena region {aws_region}")
 
+    # Retries are left to the shared retry policy, so that its total delay
+    # cap holds: turn off both pyathena's and botocore's own retries.
+    retry_args = dict(
+        retry_config=RetryConfig(attempt=1),
+        config=Config(retries={'max_attempts': 0}),
+    )
+
     # AWS credentials based authentication
     if aws_access_key_id and aws_secret_access_key:
         cursor = connect(
@@ -40,6 +52,7 @@ def create_client(config, logger: Logger):
             aws_session_token=aws_session_token,
             region_name=aws_region,
             s3_staging_dir=s3_staging_dir,
+            **retry_args,
         ).cursor()
 
     # AWS Profile based authentication
@@ -48,12 +61,17 @@ def create_client(config, logger: Logger):
             profile_name=aws_profile,
             region_name=aws_region,
             s3_staging_dir=s3_staging_dir,
+            **retry_args,
         ).cursor()
     return cursor
 
+@retry.retrying("athena.execute_sql")
 def execute_sql(sql, athena_client):
     """Run sql expression using athena client
 
+    Throttled or otherwise transient failures are retried by the shared
+    retry policy; all statements issued by the target are idempotent.
+
     Args:
         sql (string): a valid sql statement string
         athena_client ([type]): [description]
@@ -171,6 +189,8 @@ def generate_create_table_ddl(
     row_format="org.apache.hadoop.hive.serde2.OpenCSVSerde",
     serdeproperties = "'case.insensitive'='true'",
     skip_header = True,
+    bucket_by=None,
+    bucket_count=None,
 ):
     """Generate DDL for Hive table creation.
 
@@ -184,6 +204,8 @@ def generate_create_table_ddl(
         row_format (str, optional): [description]. Defaults to "org.apache.hadoop.hive.serde2.OpenCSVSerde".
         serdeproperties (str, optional): [description]
         skip_header (bool, optional): [description]. Defaults to True.
+        bucket_by (list, optional): Columns the data files are bucketed by. Defaults to None.
+        bucket_count (int, optional): Number of buckets. Defaults to None.
     """
 
     if not headers:
@@ -195,15 +217,26 @@ def generate_create_table_ddl(
     stored = "\nSTORED AS TEXTFILE"
     serdeproperties = "\nWITH SERDEPROPERTIES ({})".format(serdeproperties) if serdeproperties else ""
     location = "\nLOCATION '{}'".format(data_location) if external else ""
-    tblproperties = '\nTBLPROPERTIES ("skip.header.line.count" = "1")' if skip_header else ""
+    table_properties = []
+    if skip_header:
+        table_properties.append('"skip.header.line.count" = "1"')
+    clustered = ""
+    if bucket_by and bucket_count:
+        clustered = "CLUSTERED BY ({columns}) INTO {count} BUCKETS\n".format(
+            columns=", ".join("`{}`".format(_) for _ in bucket_by),
+            count=bucket_count,
+        )
+        table_properties.append('"bucketing_version" = "{}"'.format(bucketing.BUCKETING_VERSION))
+    tblproperties = "\nTBLPROPERTIES ({})".format(", ".join(table_properties)) if table_properties else ""
     statement = """CREATE {external_marker}TABLE IF NOT EXISTS {database}.{table} (
 {field_definitions}
 )
-{row_format}{serdeproperties}{stored}{location}{tblproperties};""".format(
+{clustered}{row_format}{serdeproperties}{stored}{location}{tblproperties};""".format(
         external_marker=external_marker,
         database=database,
         table=table,
         field_definitions=field_definitions,
+        clustered=clustered,
         row_format=row_format,
         serdeproperties=serdeproperties,
         stored=stored,
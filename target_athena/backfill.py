@@ -0,0 +1,253 @@
+"""Bulk load historical JSONL files of a stream with a pool of worker processes."""
+
+import concurrent.futures
+import glob
+import gzip
+import json
+import os
+import time
+from pathlib import Path
+
+import click
+
+from target_athena import passthrough
+
+# Target and stream of the current worker process
+_target = None
+_stream_name = None
+
+# Keys that tell Singer messages other than RECORD apart from records that
+# happen to have a `type` field
+MESSAGE_KEYS = {
+    "SCHEMA": ("stream", "schema"),
+    "STATE": ("value",),
+    "ACTIVATE_VERSION": ("stream", "version"),
+}
+
+
+def load_schema(path, key_properties=None):
+    """Read a JSON schema, or a Singer SCHEMA message, and return `(schema, key_properties)`."""
+    with open(path, encoding="utf-8") as schema_file:
+        schema = json.load(schema_file)
+    if schema.get("type") == "SCHEMA" and "schema" in schema:
+        key_properties = key_properties or schema.get("key_properties")
+        schema = schema["schema"]
+    return schema, key_properties or []
+
+
+def expand_inputs(patterns):
+    """Return the sorted, de-duplicated files matching the given globs."""
+    paths = set()
+    for pattern in patterns:
+        paths.update(
+            path for path in glob.glob(os.path.expanduser(pattern), recursive=True)
+            if os.path.isfile(path)
+        )
+    return sorted(paths)
+
+
+def _open_input(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def _create_target(config, stream_name, schema, key_properties, **kwargs):
+    from target_athena.target import TargetAthena
+
+    target = TargetAthena(config=config, **kwargs)
+    target._process_schema_message({
+        "type": "SCHEMA",
+        "stream": stream_name,
+        "schema": schema,
+        "key_properties": key_properties,
+    })
+    return target
+
+
+def _init_worker(config, stream_name, schema, key_properties):
+    global _target, _stream_name
+    _target = _create_target(config, stream_name, schema, key_properties, validate_config=False)
+    _stream_name = stream_name
+    for sink in _target._sinks_active.values():
+        # Created once by the parent process before the workers started
+        sink._database_created = sink._table_created = True
+
+
+def is_singer_message(line):
+    """Whether a line is a Singer SCHEMA, STATE or ACTIVATE_VERSION message."""
+    if not any(f'"{message_type}"' in line for message_type in MESSAGE_KEYS):
+        return False
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return False
+    if not isinstance(message, dict):
+        return False
+    required = MESSAGE_KEYS.get(message.get("type"))
+    return required is not None and all(key in message for key in required)
+
+
+def _load_raw_line(sink, line):
+    """Buffer the raw record text of a line; return False if it needs decoding instead."""
+    if '"RECORD"' in line:
+        split = passthrough.split_record_line(line)
+        if split:
+            _target._process_raw_record(sink, split[1])
+            return True
+        # Possibly an envelope that can't be split, e.g. with a non-object record
+        return False
+    record = line.strip()
+    if not record.startswith("{"):
+        return False
+    _target._process_raw_record(sink, record)
+    return True
+
+
+def _is_record_message(message):
+    return message.get("type") == "RECORD" and "record" in message
+
+
+def load_file(path):
+    """Load one input file in the current worker.
+
+    Lines are either records or Singer RECORD messages. They go through the
+    same record handling as messages read from a tap, so batches are drained
+    by the regular sink code whenever a sink is full, and once more at the
+    end of the file. Other Singer messages, as found in dumps of tap output,
+    are skipped.
+
+    Returns:
+        tuple: `(path, records, skipped messages, bytes, seconds)`
+    """
+    started_at = time.perf_counter()
+    sink = _target._sinks_active.get(_stream_name)
+    raw_sink = sink if sink is not None and sink.passthrough else None
+    record_count = skipped = 0
+    with _open_input(path) as input_file:
+        for line in input_file:
+            if not line.strip():
+                continue
+            if is_singer_message(line):
+                skipped += 1
+                continue
+            record_count += 1
+            if raw_sink and _load_raw_line(raw_sink, line):
+                continue
+            message = json.loads(line)
+            if raw_sink and isinstance(message, dict) and not _is_record_message(message):
+                # A record mentioning "RECORD": keep its text as received too
+                _target._process_raw_record(raw_sink, line.strip())
+                continue
+            if not isinstance(message, dict) or not _is_record_message(message):
+                message = {"type": "RECORD", "record": message}
+            message["stream"] = _stream_name
+            _target._process_record_message(message)
+    for sink in list(_target._sinks_active.values()):
+        _target.drain_one(sink)
+    return path, record_count, skipped, os.path.getsize(path), time.perf_counter() - started_at
+
+
+def _format_rate(count, seconds, unit, digits=0):
+    return f"{count / seconds:,.{digits}f} {unit}/s" if seconds else f"- {unit}/s"
+
+
+@click.command(
+    help="Load historical JSONL files of one stream in parallel.",
+    context_settings={"help_option_names": ["--help"]},
+)
+@click.option(
+    "--config",
+    multiple=True,
+    help="Configuration file location or 'ENV' to use environment variables.",
+    type=click.STRING,
+    default=(),
+)
+@click.option("--stream", "stream_name", required=True, help="Name of the stream to load.")
+@click.option(
+    "--schema",
+    "schema_path",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON schema of the stream, or a Singer SCHEMA message.",
+)
+@click.option(
+    "--key-properties",
+    help="Comma separated key properties, overriding those of a SCHEMA message.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    show_default=True,
+    help="Number of worker processes.",
+)
+@click.argument("inputs", nargs=-1, required=True)
+def backfill(config, stream_name, schema_path, key_properties, workers, inputs):
+    """Load every file matching INPUTS, which may be globs such as 'dump/**/*.jsonl.gz'."""
+    paths = expand_inputs(inputs)
+    if not paths:
+        raise click.UsageError(f"No input files match {', '.join(inputs)}")
+
+    parse_env_config = "ENV" in config
+    config_files = [Path(path) for path in config if path != "ENV"]
+    for path in config_files:
+        if not path.is_file():
+            raise FileNotFoundError(
+                f"Could not locate config file at '{path}'."
+                "Please check that the file exists."
+            )
+    schema, key_properties = load_schema(
+        schema_path,
+        key_properties.split(",") if key_properties else None,
+    )
+
+    # Validate the config and create the database and table once, up front
+    target = _create_target(
+        config_files or None,
+        stream_name,
+        schema,
+        key_properties,
+        parse_env_config=parse_env_config,
+    )
+    config = dict(target.config)
+    for sink in target._sinks_active.values():
+        sink._create_table()
+
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    click.echo(
+        f"Loading {len(paths)} files ({total_bytes / 1024 ** 2:,.1f} MB) into "
+        f"'{stream_name}' with {workers} workers"
+    )
+    started_at = time.perf_counter()
+    done_records = done_bytes = done_files = done_skipped = 0
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(config, stream_name, schema, key_properties),
+    ) as pool:
+        futures = [pool.submit(load_file, path) for path in paths]
+        for future in concurrent.futures.as_completed(futures):
+            path, record_count, skipped, size, seconds = future.result()
+            done_files += 1
+            done_records += record_count
+            done_skipped += skipped
+            done_bytes += size
+            elapsed = time.perf_counter() - started_at
+            skipped_note = f" ({skipped:,} other messages skipped)" if skipped else ""
+            click.echo(
+                f"[{done_files}/{len(paths)}] {path}: {record_count:,} records{skipped_note} in "
+                f"{seconds:.1f}s | total {done_records:,} records, "
+                f"{done_bytes / total_bytes if total_bytes else 1:.0%} of input, "
+                f"{_format_rate(done_records, elapsed, 'records')}"
+            )
+
+    elapsed = time.perf_counter() - started_at
+    if done_skipped:
+        click.echo(f"Skipped {done_skipped:,} Singer messages other than RECORD")
+    click.echo(
+        f"Loaded {done_records:,} records from {done_files} files "
+        f"({done_bytes / 1024 ** 2:,.1f} MB) in {elapsed:.1f}s: "
+        f"{_format_rate(done_records, elapsed, 'records')}, "
+        f"{_format_rate(done_bytes / 1024 ** 2, elapsed, 'MB', digits=1)}"
+    )
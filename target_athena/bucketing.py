@@ -0,0 +1,51 @@
+"""Hive compatible hash bucketing of records.
+
+Rows are assigned to buckets the way Hive (bucketing version 1) and Athena
+do for STRING columns, so a table declared `CLUSTERED BY (...) INTO N
+BUCKETS` can prune buckets on point lookups and join bucket by bucket.
+"""
+
+import json
+
+BUCKETING_VERSION = 1
+
+
+def _to_text(value, object_format="jsonl"):
+    """Render a value as the text Athena reads from its STRING column in the written file."""
+    if isinstance(value, str):
+        return value
+    if object_format == "csv":
+        # csv.writer writes `str()` of non-string values, e.g. `True`
+        return str(value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return json.dumps(value)
+
+
+def hive_string_hash(value):
+    """Hash a string like Hive's `Text` hash: `h = 31 * h + byte` over signed UTF-8 bytes."""
+    result = 0
+    for byte in value.encode("utf-8"):
+        if byte > 127:
+            byte -= 256
+        result = (31 * result + byte) & 0xFFFFFFFF
+    return result
+
+
+def bucket_of(record, columns, bucket_count, object_format="jsonl"):
+    """Return the bucket number of a record for the given bucket columns."""
+    result = 0
+    for column in columns:
+        value = record.get(column)
+        column_hash = 0 if value is None else hive_string_hash(_to_text(value, object_format))
+        result = (31 * result + column_hash) & 0xFFFFFFFF
+    return (result & 0x7FFFFFFF) % bucket_count
+
+
+def group_by_bucket(records, columns, bucket_count, object_format="jsonl"):
+    """Split records into `{bucket: [records]}`, keeping their relative order."""
+    buckets = {}
+    for record in records:
+        bucket = bucket_of(record, columns, bucket_count, object_format)
+        buckets.setdefault(bucket, []).append(record)
+    return dict(sorted(buckets.items()))
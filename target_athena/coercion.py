@@ -0,0 +1,167 @@
+"""Schema-driven type coercion of record batches.
+
+Coercers are compiled once per stream from the Singer schema and then applied
+column by column to a whole batch, so values reach the writers already in the
+form Athena parses: timestamps as `YYYY-MM-DD HH:MM:SS.fff` in UTC, dates as
+`YYYY-MM-DD`, and JSON-native numbers and booleans.
+"""
+
+import math
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+_TRUE_STRINGS = {"true", "t", "yes", "y", "1"}
+_FALSE_STRINGS = {"false", "f", "no", "n", "0"}
+
+
+def _parse_datetime(value):
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value)
+
+
+def to_timestamp(value):
+    if isinstance(value, str):
+        try:
+            value = _parse_datetime(value)
+        except ValueError:
+            return value
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat(sep=" ", timespec="milliseconds")
+    if isinstance(value, date):
+        return value.isoformat() + " 00:00:00.000"
+    return value
+
+
+def to_date(value):
+    if isinstance(value, str):
+        try:
+            value = _parse_datetime(value)
+        except ValueError:
+            return value
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def to_integer(value):
+    if type(value) is int:
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def to_number(value):
+    if type(value) is int:
+        return value
+    if type(value) is float:
+        return value if math.isfinite(value) else None
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            return None
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, str):
+        try:
+            return to_number(Decimal(value))
+        except ArithmeticError:
+            return value
+    return value
+
+
+def to_boolean(value):
+    if type(value) is bool:
+        return value
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in _TRUE_STRINGS:
+            return True
+        if lowered in _FALSE_STRINGS:
+            return False
+        return value
+    if isinstance(value, (int, float, Decimal)):
+        return bool(value)
+    return value
+
+
+def _object_coercer(coercers):
+    def coerce(value):
+        if isinstance(value, dict):
+            coerce_record(value, coercers)
+        return value
+    return coerce
+
+
+def _array_coercer(item_coercer):
+    def coerce(value):
+        if isinstance(value, list):
+            return [item if item is None else item_coercer(item) for item in value]
+        return value
+    return coerce
+
+
+def compile_coercer(property_schema):
+    """Return the coercion function for one property, or None if none is needed."""
+    types = property_schema.get("type", [])
+    if isinstance(types, str):
+        types = [types]
+    types = [t for t in types if t != "null"]
+    if len(types) != 1:
+        # Untyped or union columns are written as received.
+        return None
+    json_type = types[0]
+
+    if json_type == "string":
+        string_format = property_schema.get("format")
+        if string_format == "date-time":
+            return to_timestamp
+        if string_format == "date":
+            return to_date
+        return None
+    if json_type == "integer":
+        return to_integer
+    if json_type == "number":
+        return to_number
+    if json_type == "boolean":
+        return to_boolean
+    if json_type == "object":
+        coercers = compile_coercers(property_schema)
+        return _object_coercer(coercers) if coercers else None
+    if json_type == "array":
+        item_coercer = compile_coercer(property_schema.get("items") or {})
+        return _array_coercer(item_coercer) if item_coercer else None
+    return None
+
+
+def compile_coercers(schema):
+    """Compile a `{column: coercer}` mapping from an object schema.
+
+    Columns that are written as received are left out of the mapping.
+    """
+    coercers = {}
+    for name, property_schema in (schema.get("properties") or {}).items():
+        coercer = compile_coercer(property_schema)
+        if coercer:
+            coercers[name] = coercer
+    return coercers
+
+
+def coerce_record(record, coercers):
+    for name, coercer in coercers.items():
+        value = record.get(name)
+        if value is not None:
+            record[name] = coercer(value)
+
+
+def coerce_batch(records, coercers):
+    """Coerce a batch of records in place, one column at a time."""
+    for name, coercer in coercers.items():
+        for record in records:
+            value = record.get(name)
+            if value is not None:
+                record[name] = coercer(value)
@@ -0,0 +1,95 @@
+"""File compression and adaptive compression level tuning."""
+
+import gzip
+import shutil
+
+DEFAULT_LEVELS = {"gzip": 9}
+LEVEL_BOUNDS = {"gzip": (1, 9)}
+EXTENSIONS = {"gzip": ".gz"}
+
+
+def get_compression(config):
+    """Return the configured compression codec, or None for no compression."""
+    compression = config.get("compression")
+    if compression is None or compression.lower() == "none":
+        return None
+    if compression not in EXTENSIONS:
+        raise NotImplementedError(
+            "Compression type '{}' is not supported. "
+            "Expected: 'none' or 'gzip'".format(compression)
+        )
+    return compression
+
+
+def compress_file(filename, compression, level=None):
+    """Compress a file next to the original and return the compressed file name."""
+    compressed_file = filename + EXTENSIONS[compression]
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+    with open(filename, "rb") as f_in:
+        with gzip.open(compressed_file, "wb", compresslevel=level) as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    return compressed_file
+
+
+class AdaptiveCompressionLevel:
+    """Pick the compression level that maximizes end-to-end records per second.
+
+    After each batch, the time spent compressing and uploading is recorded
+    against the level that was used, and the level moves one step towards
+    whichever neighbour is (or might be) faster. Neighbour measurements are
+    dropped periodically so that the level follows changes in CPU load or
+    network throughput.
+    """
+
+    SMOOTHING = 0.5
+    REPROBE_INTERVAL = 10
+
+    def __init__(self, min_level, max_level, level=None):
+        if min_level > max_level:
+            raise ValueError(
+                "Invalid compression level bounds: {} > {}".format(min_level, max_level)
+            )
+        self.min_level = min_level
+        self.max_level = max_level
+        if level is None:
+            level = (min_level + max_level) // 2
+        self.level = min(max(level, min_level), max_level)
+        self._direction = -1
+        self._throughput = {}
+        self._stable_batches = 0
+
+    def record(self, records, compress_seconds, upload_seconds):
+        """Record the timings of a batch and return the level for the next one."""
+        elapsed = compress_seconds + upload_seconds
+        if records <= 0 or elapsed <= 0:
+            return self.level
+
+        throughput = records / elapsed
+        previous = self._throughput.get(self.level)
+        if previous is not None:
+            throughput = previous + self.SMOOTHING * (throughput - previous)
+        self._throughput[self.level] = throughput
+
+        next_level = self._next_level(throughput)
+        if next_level == self.level:
+            self._stable_batches += 1
+            if self._stable_batches >= self.REPROBE_INTERVAL:
+                self._throughput.pop(self.level - 1, None)
+                self._throughput.pop(self.level + 1, None)
+                self._stable_batches = 0
+        else:
+            self._stable_batches = 0
+        self.level = next_level
+        return self.level
+
+    def _next_level(self, throughput):
+        for direction in (self._direction, -self._direction):
+            candidate = self.level + direction
+            if not self.min_level <= candidate <= self.max_level:
+                continue
+            measured = self._throughput.get(candidate)
+            if measured is None or measured > throughput:
+                self._direction = direction
+                return candidate
+        return self.level
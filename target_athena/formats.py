@@ -2,45 +2,67 @@
 
 import os
 import csv
+import itertools
 import json
 
-def write_csv(filename, record, header=None, delimiter= ",", quotechar='"'):
+class CSVWriter:
+    """Write records as CSV rows in a fixed column order.
 
-    file_is_empty = (not os.path.isfile(filename)) or os.stat(
-        filename
-    ).st_size == 0
-    
-    if not header and not file_is_empty:
-        with open(filename, "r") as csv_file:
-            reader = csv.reader(
-                csv_file, delimiter=delimiter, quotechar=quotechar
-            )
-            first_line = next(reader)
-            header = (
-                first_line if first_line else record.keys()
+    Records are projected column by column, in chunks of `CHUNK_SIZE`, and
+    each chunk is written with one `writerows` call.
+    """
+
+    CHUNK_SIZE = 10000
+
+    def __init__(self, columns, delimiter=",", quotechar='"'):
+        self.columns = list(columns)
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+
+    def _project(self, records):
+        projected = []
+        for column in self.columns:
+            values = [record.get(column) for record in records]
+            # Athena does not support newline characters in CSV format.
+            # Replace `\n` with escaped text `\\n` ('\n')
+            if any(isinstance(value, str) and "\n" in value for value in values):
+                values = [
+                    value.replace("\n", "\\n") if isinstance(value, str) else value
+                    for value in values
+                ]
+            projected.append(values)
+        return zip(*projected)
+
+    def write(self, filename, records):
+        """Append records to `filename`, with a header if the file is new; return the count."""
+        records = iter(records)
+        chunk = list(itertools.islice(records, self.CHUNK_SIZE))
+        if not chunk:
+            return 0
+
+        file_is_empty = (not os.path.isfile(filename)) or os.stat(
+            filename
+        ).st_size == 0
+        count = 0
+        with open(filename, "a", newline="") as csv_file:
+            writer = csv.writer(
+                csv_file,
+                delimiter=self.delimiter,
+                quotechar=self.quotechar,
             )
-    else:
-        header = record.keys()
-
-    # Athena does not support newline characters in CSV format.
-    # Remove `\n` and replace with escaped text `\\n` ('\n')
-    for k, v in record.items():
-        if isinstance(v, str) and "\n" in v:
-            record[k] = v.replace("\n", "\\n")
-
-    with open(filename, "a") as csv_file:
-        writer = csv.DictWriter(
-            csv_file,
-            header,
-            extrasaction="ignore",
-            delimiter=delimiter,
-            quotechar=quotechar,
-        )
-        if file_is_empty:
-            writer.writeheader()
-
-        writer.writerow(record)
+            if file_is_empty:
+                writer.writerow(self.columns)
+            while chunk:
+                writer.writerows(self._project(chunk))
+                count += len(chunk)
+                chunk = list(itertools.islice(records, self.CHUNK_SIZE))
+        return count
 
 def write_jsonl(filename, record):
     with open(filename, 'a', encoding='utf-8') as json_file:
-        json_file.write(json.dumps(record, default=str) + '\n')
\ No newline at end of file
+        json_file.write(json.dumps(record, default=str) + '\n')
+
+def write_jsonl_lines(filename, lines):
+    """Append lines of JSON text as they are."""
+    with open(filename, 'a', encoding='utf-8') as json_file:
+        json_file.writelines(line + '\n' for line in lines)
@@ -0,0 +1,74 @@
+"""Split RECORD messages without decoding the record itself."""
+
+import json
+import re
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Strings are matched whole so that brackets inside them are skipped
+_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
+
+def _skip_whitespace(line, pos):
+    return _WHITESPACE.match(line, pos).end()
+
+
+def _skip_container(line, pos):
+    """Return the end of the object or array starting at `pos`, without decoding it."""
+    depth = 0
+    for match in _TOKENS.finditer(line, pos):
+        token = match.group()
+        if token in ("{", "["):
+            depth += 1
+        elif token in ("}", "]"):
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    raise ValueError("Unterminated JSON value")
+
+
+def split_record_line(line):
+    """Split a RECORD message into its stream name and the raw JSON text of its record.
+
+    Only the message envelope is decoded; the record is located by bracket
+    matching and returned as it appears in the line. Returns None for other
+    message types and for lines that can't be split this way, which are
+    then left to the regular message handling.
+    """
+    fields = {}
+    record = None
+    try:
+        pos = _skip_whitespace(line, 0)
+        if line[pos] != "{":
+            return None
+        pos += 1
+        while True:
+            pos = _skip_whitespace(line, pos)
+            if line[pos] == "}":
+                break
+            key, pos = _DECODER.raw_decode(line, pos)
+            pos = _skip_whitespace(line, pos)
+            if line[pos] != ":":
+                return None
+            pos = _skip_whitespace(line, pos + 1)
+            if key == "record" and line[pos] == "{":
+                end = _skip_container(line, pos)
+                record = line[pos:end]
+                pos = end
+            else:
+                fields[key], pos = _DECODER.raw_decode(line, pos)
+            pos = _skip_whitespace(line, pos)
+            if line[pos] == ",":
+                pos += 1
+            elif line[pos] == "}":
+                break
+            else:
+                return None
+    except (IndexError, ValueError):
+        return None
+
+    if fields.get("type") != "RECORD" or record is None:
+        return None
+    if not isinstance(fields.get("stream"), str):
+        return None
+    return fields["stream"], record
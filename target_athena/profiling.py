@@ -0,0 +1,146 @@
+"""Opt-in per-batch profiling with cProfile and tracemalloc."""
+
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+
+LOGGER = logging.getLogger("target_athena")
+
+# cProfile and tracemalloc are process wide on recent Pythons, so only one
+# batch is profiled at a time; batches drained concurrently are skipped.
+_PROFILING_LOCK = threading.Lock()
+
+
+class _NoProfile:
+    """Stand-in for batches that are not sampled."""
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+
+class _BatchProfile:
+    """cProfile stats per stage plus a tracemalloc diff over the whole batch."""
+
+    def __init__(self, path_prefix, top_n):
+        self.path_prefix = path_prefix
+        self.top_n = top_n
+        self.stages = []
+        self._started_tracemalloc = False
+        self._start_snapshot = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        self._start_snapshot = tracemalloc.take_snapshot()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.stages.append((name, profile))
+
+    def finish(self):
+        end_snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+        combined = None
+        for name, profile in self.stages:
+            profile.dump_stats(f"{self.path_prefix}-{name}.prof")
+            if combined is None:
+                combined = pstats.Stats(profile)
+            else:
+                combined.add(profile)
+        if combined is not None:
+            combined.dump_stats(f"{self.path_prefix}.prof")
+
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+        diff = end_snapshot.filter_traces(filters).compare_to(
+            self._start_snapshot.filter_traces(filters), "lineno"
+        )
+        with open(f"{self.path_prefix}-memory.txt", "w") as report:
+            report.write(f"Peak traced memory: {peak / 1024:.1f} KiB\n")
+            report.write(f"Top {self.top_n} allocation changes by line:\n")
+            for stat in diff[:self.top_n]:
+                report.write(f"{stat}\n")
+        LOGGER.info(f"Wrote batch profile to '{self.path_prefix}.prof'")
+
+
+class BatchProfiler:
+    """Profile every n-th batch of a stream.
+
+    Each sampled batch writes, under `directory`:
+
+    - `{stream}-{pid}-{batch}.prof`: cProfile stats of the whole batch
+    - `{stream}-{pid}-{batch}-{stage}.prof`: cProfile stats of each stage
+    - `{stream}-{pid}-{batch}-memory.txt`: peak traced memory and the top-N
+      allocation changes over the batch, from tracemalloc
+
+    The process id keeps the files of `backfill` workers, which count
+    batches separately, apart.
+
+    The `.prof` files load in snakeviz, pstats, or flamegraph converters
+    such as flameprof.
+    """
+
+    def __init__(self, stream_name, directory=None, every_n_batches=10, top_n=25):
+        self.stream_name = stream_name
+        self.directory = directory
+        self.every_n_batches = max(every_n_batches, 1)
+        self.top_n = top_n
+        self._batches = 0
+
+    @classmethod
+    def from_config(cls, stream_name, config):
+        return cls(
+            stream_name,
+            directory=config.get("profile_dir"),
+            every_n_batches=config.get("profile_every_n_batches") or 10,
+            top_n=config.get("profile_top_n") or 25,
+        )
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context of one batch; yields an object whose `stage(name)` profiles a stage."""
+        self._batches += 1
+        sampled = (
+            self.directory
+            and (self._batches - 1) % self.every_n_batches == 0
+            and _PROFILING_LOCK.acquire(blocking=False)
+        )
+        if not sampled:
+            yield _NoProfile()
+            return
+
+        try:
+            directory = os.path.expanduser(self.directory)
+            os.makedirs(directory, exist_ok=True)
+            profile = _BatchProfile(
+                os.path.join(
+                    directory, f"{self.stream_name}-{os.getpid()}-{self._batches:06d}"
+                ),
+                self.top_n,
+            )
+            profile.start()
+            try:
+                yield profile
+            finally:
+                # Failed batches are reported too; they are often the interesting ones.
+                profile.finish()
+        finally:
+            _PROFILING_LOCK.release()
@@ -0,0 +1,184 @@
+"""Shared retry policy for S3 and Athena calls."""
+
+import collections
+import functools
+import logging
+import random
+import threading
+import time
+
+LOGGER = logging.getLogger("target_athena")
+
+# AWS error codes that are safe to retry: throttling and transient server errors.
+RETRIABLE_ERROR_CODES = {
+    "BandwidthLimitExceeded",
+    "InternalError",
+    "InternalFailure",
+    "InternalServerException",
+    "PriorRequestNotComplete",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "ServiceUnavailable",
+    "ServiceUnavailableException",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+}
+
+# Connection level botocore/urllib3 errors, matched by name so that this
+# module does not need to import botocore.
+RETRIABLE_EXCEPTION_NAMES = {
+    "ConnectionClosedError",
+    "ConnectTimeoutError",
+    "EndpointConnectionError",
+    "ReadTimeoutError",
+    "ResponseStreamingError",
+}
+
+
+def is_retriable(exc):
+    """Classify an exception raised by an S3 or Athena call as retriable or not."""
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return (
+            code in RETRIABLE_ERROR_CODES
+            or (isinstance(status, int) and (status >= 500 or status == 429))
+        )
+    if type(exc).__name__ in RETRIABLE_EXCEPTION_NAMES:
+        return True
+    if type(exc).__module__.startswith("pyathena"):
+        # pyathena reports failed queries as DB-API errors carrying the message only
+        message = str(exc)
+        return any(code in message for code in RETRIABLE_ERROR_CODES)
+    return False
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter and a capped total delay.
+
+    The n-th retry sleeps a random time between 0 and
+    `min(max_delay, base_delay * 2 ** (n - 1))` seconds. An operation is given
+    up once `max_attempts` is reached or once `max_total_delay` seconds have
+    been spent sleeping. Only errors accepted by `classify` are retried.
+
+    Attempts, retries and give-ups are counted per operation in `counters`.
+    """
+
+    def __init__(
+        self,
+        max_attempts=5,
+        base_delay=0.5,
+        max_delay=20.0,
+        max_total_delay=60.0,
+        classify=is_retriable,
+        sleep=time.sleep,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_total_delay = max_total_delay
+        self.classify = classify
+        self.sleep = sleep
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        defaults = cls()
+        return cls(
+            max_attempts=config.get("retry_max_attempts") or defaults.max_attempts,
+            base_delay=config.get("retry_base_delay") or defaults.base_delay,
+            max_delay=config.get("retry_max_delay") or defaults.max_delay,
+            max_total_delay=config.get("retry_max_total_delay") or defaults.max_total_delay,
+        )
+
+    def _count(self, operation, event):
+        with self._lock:
+            self.counters[(operation, event)] += 1
+
+    def snapshot(self):
+        """Return the counters as `{operation: {event: count}}`."""
+        with self._lock:
+            items = list(self.counters.items())
+        result = {}
+        for (operation, event), count in sorted(items):
+            result.setdefault(operation, {})[event] = count
+        return result
+
+    def since(self, before):
+        """Return how the counters grew since the `before` snapshot, per operation."""
+        result = {}
+        for operation, counts in self.snapshot().items():
+            previous = before.get(operation, {})
+            changes = {
+                event: count - previous.get(event, 0)
+                for event, count in counts.items()
+                if count > previous.get(event, 0)
+            }
+            if changes:
+                result[operation] = changes
+        return result
+
+    def call(self, operation, func, *args, **kwargs):
+        """Call `func`, retrying retriable errors according to the policy."""
+        total_delay = 0.0
+        attempt = 0
+        while True:
+            attempt += 1
+            self._count(operation, "attempts")
+            try:
+                return func(*args, **kwargs)
+            except Exception as exc:
+                if not self.classify(exc):
+                    raise
+                remaining = self.max_total_delay - total_delay
+                if attempt >= self.max_attempts or remaining <= 0:
+                    self._count(operation, "give_ups")
+                    LOGGER.warning(
+                        "Giving up on %s after %d attempts and %.1fs of backoff: %s",
+                        operation, attempt, total_delay, exc,
+                    )
+                    raise
+                delay = min(
+                    random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))),
+                    remaining,
+                )
+                total_delay += delay
+                self._count(operation, "retries")
+                LOGGER.info(
+                    "Error detected communicating with Amazon in %s, retrying in %.2fs "
+                    "(attempt %d): %s",
+                    operation, delay, attempt, exc,
+                )
+                self.sleep(delay)
+
+
+_policy = RetryPolicy()
+
+
+def get_policy():
+    return _policy
+
+
+def configure(config):
+    """Replace the shared policy with one built from the target config."""
+    global _policy
+    _policy = RetryPolicy.from_config(config)
+    return _policy
+
+
+def retrying(operation):
+    """Decorate a function so that its calls go through the shared retry policy."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return get_policy().call(operation, func, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,26 +1,17 @@
+import concurrent.futures
+import logging
 import os
-import backoff
-import boto3
-import singer
-from botocore.exceptions import ClientError
 
-LOGGER = singer.get_logger('target_athena')
+from target_athena import retry
 
+LOGGER = logging.getLogger('target_athena')
 
-def retry_pattern():
-    return backoff.on_exception(backoff.expo,
-                                ClientError,
-                                max_tries=5,
-                                on_backoff=log_backoff_attempt,
-                                factor=10)
 
-
-def log_backoff_attempt(details):
-    LOGGER.info("Error detected communicating with Amazon, triggering backoff: %d try", details.get("tries"))
-
-
-@retry_pattern()
+@retry.retrying("s3.create_client")
 def create_client(config):
+    import boto3
+    from botocore.config import Config
+
     LOGGER.info("Attempting to create AWS session")
 
     # Get the required parameters from config file and/or environment variables
@@ -40,37 +31,155 @@ def create_client(config):
     else:
         aws_session = boto3.session.Session(profile_name=aws_profile)
 
-    return aws_session.client('s3')
+    # Retries are handled by target_athena.retry, not by botocore, so that a
+    # single policy bounds the total time spent retrying.
+    return aws_session.client('s3', config=Config(retries={'max_attempts': 0}))
+
+
+def get_encryption_args(encryption_type=None, encryption_key=None):
+    """Return the S3 extra args and a log description for an encryption setup."""
+    if encryption_type is None or encryption_type.lower() == "none":
+        # No encryption config (defaults to settings on the bucket):
+        return None, ""
+
+    if encryption_type.lower() == "kms":
+        encryption_args = {"ServerSideEncryption": "aws:kms"}
+        if encryption_key:
+            encryption_args["SSEKMSKeyId"] = encryption_key
+            return encryption_args, (
+                " using KMS encryption key ID '{}'"
+                .format(encryption_key)
+            )
+        return encryption_args, " using default KMS encryption"
+
+    raise NotImplementedError(
+        "Encryption type '{}' is not supported. "
+        "Expected: 'none' or 'KMS'"
+        .format(encryption_type)
+    )
 
 
 # pylint: disable=too-many-arguments
-@retry_pattern()
+@retry.retrying("s3.upload_file")
 def upload_file(filename, s3_client, bucket, s3_key,
                 encryption_type=None, encryption_key=None):
 
-    if encryption_type is None or encryption_type.lower() == "none":
-        # No encryption config (defaults to settings on the bucket):
-        encryption_desc = ""
-        encryption_args = None
-    else:
-        if encryption_type.lower() == "kms":
-            encryption_args = {"ServerSideEncryption": "aws:kms"}
-            if encryption_key:
-                encryption_desc = (
-                    " using KMS encryption key ID '{}'"
-                    .format(encryption_key)
-                )
-                encryption_args["SSEKMSKeyId"] = encryption_key
-            else:
-                encryption_desc = " using default KMS encryption"
-        else:
-            raise NotImplementedError(
-                "Encryption type '{}' is not supported. "
-                "Expected: 'none' or 'KMS'"
-                .format(encryption_type)
-            )
+    encryption_args, encryption_desc = get_encryption_args(encryption_type, encryption_key)
     LOGGER.info(
         "Uploading {} to bucket {} at {}{}"
         .format(filename, bucket, s3_key, encryption_desc)
     )
-    s3_client.upload_file(filename, bucket, s3_key, ExtraArgs=encryption_args)
+    with open(filename, "rb") as data:
+        s3_client.put_object(Bucket=bucket, Key=s3_key, Body=data, **(encryption_args or {}))
+
+
+# pylint: disable=too-many-arguments
+def upload_file_multipart(filename, s3_client, bucket, s3_key, part_size,
+                          encryption_type=None, encryption_key=None, max_concurrency=1):
+    """Upload a file with an explicit S3 multipart upload.
+
+    Up to `max_concurrency` parts are uploaded at a time. Each part is read
+    from the file by the thread uploading it, so no more than that many
+    parts are held in memory. Every part is retried on its own, so a
+    transient error only re-sends that part. The upload is aborted if a part
+    fails for good, so no orphaned parts are left behind in the bucket.
+    """
+    encryption_args, encryption_desc = get_encryption_args(encryption_type, encryption_key)
+    # An empty file is still uploaded as a single, empty part
+    part_count = max(1, -(-os.path.getsize(filename) // part_size))
+    LOGGER.info(
+        "Uploading {} to bucket {} at {} in {} parts of {} bytes{}"
+        .format(filename, bucket, s3_key, part_count, part_size, encryption_desc)
+    )
+    upload_id = _create_multipart_upload(
+        s3_client, bucket, s3_key, encryption_args or {}
+    )
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(max_concurrency, part_count))
+        ) as pool:
+            futures = [
+                pool.submit(
+                    _upload_file_part,
+                    filename, s3_client, bucket, s3_key, upload_id, part_number, part_size,
+                )
+                for part_number in range(1, part_count + 1)
+            ]
+            try:
+                parts = [
+                    {"ETag": future.result(), "PartNumber": part_number}
+                    for part_number, future in enumerate(futures, 1)
+                ]
+            except Exception:
+                # Don't start the remaining parts of an upload about to be aborted
+                for future in futures:
+                    future.cancel()
+                raise
+        _complete_multipart_upload(s3_client, bucket, s3_key, upload_id, parts)
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=s3_key, UploadId=upload_id)
+        raise
+
+
+# pylint: disable=too-many-arguments
+def _upload_file_part(filename, s3_client, bucket, s3_key, upload_id, part_number, part_size):
+    with open(filename, "rb") as data:
+        data.seek((part_number - 1) * part_size)
+        body = data.read(part_size)
+    return _upload_part(s3_client, bucket, s3_key, upload_id, part_number, body)
+
+
+@retry.retrying("s3.create_multipart_upload")
+def _create_multipart_upload(s3_client, bucket, s3_key, encryption_args):
+    response = s3_client.create_multipart_upload(Bucket=bucket, Key=s3_key, **encryption_args)
+    return response["UploadId"]
+
+
+# pylint: disable=too-many-arguments
+@retry.retrying("s3.upload_part")
+def _upload_part(s3_client, bucket, s3_key, upload_id, part_number, body):
+    response = s3_client.upload_part(
+        Bucket=bucket, Key=s3_key, UploadId=upload_id, PartNumber=part_number, Body=body
+    )
+    return response["ETag"]
+
+
+@retry.retrying("s3.complete_multipart_upload")
+def _complete_multipart_upload(s3_client, bucket, s3_key, upload_id, parts):
+    s3_client.complete_multipart_upload(
+        Bucket=bucket, Key=s3_key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+    )
+
+
+@retry.retrying("s3.head_object")
+def head_object(s3_client, bucket, s3_key):
+    """Return the size and modification time of an object, or None if it does not exist."""
+    from botocore.exceptions import ClientError
+
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=s3_key)
+    except ClientError as exc:
+        if exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return {"size": response["ContentLength"], "last_modified": response["LastModified"]}
+
+
+def list_keys(s3_client, bucket, prefix=""):
+    """Yield every object key in the bucket under the given prefix."""
+    continuation_token = None
+    while True:
+        page = _list_objects_page(s3_client, bucket, prefix, continuation_token)
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
+        if not page.get("IsTruncated"):
+            return
+        continuation_token = page["NextContinuationToken"]
+
+
+@retry.retrying("s3.list_objects")
+def _list_objects_page(s3_client, bucket, prefix, continuation_token):
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if continuation_token:
+        kwargs["ContinuationToken"] = continuation_token
+    return s3_client.list_objects_v2(**kwargs)
@@ -0,0 +1,69 @@
+"""Target-wide memory budget deciding which sinks to drain."""
+
+import threading
+
+DRAIN_POLICIES = ("largest", "oldest")
+
+
+class MemoryBudgetScheduler:
+    """Keep the bytes buffered across all sinks under a global budget.
+
+    Sinks report the estimated size of every record they buffer with
+    `track()` and of every batch they drain with `release()`. Once the total
+    exceeds `budget_bytes`, `select()` picks sinks to drain until the total
+    falls to `LOW_WATERMARK` of the budget: the largest buffers first, or the
+    ones holding the oldest records first, depending on `policy`.
+    """
+
+    LOW_WATERMARK = 0.75
+
+    def __init__(self, budget_bytes, policy="largest"):
+        if policy not in DRAIN_POLICIES:
+            raise ValueError(
+                "Drain policy '{}' is not supported. "
+                "Expected: 'largest' or 'oldest'".format(policy)
+            )
+        self.budget_bytes = budget_bytes
+        self.policy = policy
+        self.buffered_bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Return a scheduler if `max_buffer_bytes` is configured, else None."""
+        if not config.get("max_buffer_bytes"):
+            return None
+        return cls(config["max_buffer_bytes"], config.get("drain_policy") or "largest")
+
+    def track(self, nbytes):
+        with self._lock:
+            self.buffered_bytes += nbytes
+
+    def release(self, nbytes):
+        with self._lock:
+            self.buffered_bytes -= nbytes
+
+    @property
+    def over_budget(self):
+        return self.buffered_bytes > self.budget_bytes
+
+    def select(self, sinks):
+        """Return the sinks to drain, in order, to get back under the budget."""
+        total = self.buffered_bytes
+        if total <= self.budget_bytes:
+            return []
+
+        candidates = [sink for sink in sinks if sink.buffered_bytes]
+        if self.policy == "oldest":
+            candidates.sort(key=lambda sink: sink.buffered_since)
+        else:
+            candidates.sort(key=lambda sink: sink.buffered_bytes, reverse=True)
+
+        selected = []
+        low_watermark = self.budget_bytes * self.LOW_WATERMARK
+        for sink in candidates:
+            if total <= low_watermark:
+                break
+            selected.append(sink)
+            total -= sink.buffered_bytes
+        return selected
@@ -2,16 +2,23 @@
 
 from datetime import datetime
 import csv
-import gzip
+import json
 import os
-import shutil
+import time
 from typing import List
 import tempfile
+import uuid
 
 from singer_sdk.sinks import BatchSink
 
 from target_athena import athena
-from target_athena import s3
+from target_athena import bucketing
+from target_athena import coercion
+from target_athena import compression
+from target_athena import profiling
+from target_athena import retry
+from target_athena import sorting
+from target_athena import storage
 from target_athena import utils
 from target_athena import formats
 
@@ -28,17 +35,33 @@ class AthenaSink(BatchSink):
         key_properties,
     ):
         super().__init__(target=target, stream_name=stream_name, schema=schema, key_properties=key_properties)
-        self._s3_client = None
+        # Clients and the database are set up on the first drain, not here, so
+        # that startup does no network round trips.
+        self._storage = None
         self._athena_client = None
+        self._database_created = False
+        self._table_created = False
+        self._coercers = coercion.compile_coercers(self.schema)
+        # Columns of the table and of CSV files, in the same order
+        if self.config.get("flatten_records"):
+            self.columns = utils.flatten_schema_columns(self.schema["properties"])
+        else:
+            self.columns = list(self.schema["properties"].keys())
+        self._compression_tuner = None
+        self.profiler = profiling.BatchProfiler.from_config(stream_name, self.config)
+        self.passthrough = self._passthrough_enabled()
+        self._raw_records_read = 0
 
-        ddl = athena.generate_create_database_ddl(self.config["athena_database"])
-        athena.execute_sql(ddl, self.athena_client)
+        # Memory accounting for the target-wide buffer budget
+        self._scheduler = getattr(target, "scheduler", None)
+        self.buffered_bytes = 0
+        self.buffered_since = None
 
     @property
-    def s3_client(self):
-        if not self._s3_client:
-            self._s3_client = s3.create_client(self.config)
-        return self._s3_client
+    def storage(self):
+        if not self._storage:
+            self._storage = storage.create_backend(self.config)
+        return self._storage
 
     @property
     def athena_client(self):
@@ -46,24 +69,136 @@ class AthenaSink(BatchSink):
             self._athena_client = athena.create_client(self.config, self.logger)
         return self._athena_client
 
+    def _ensure_database(self):
+        if not self._database_created:
+            ddl = athena.generate_create_database_ddl(self.config["athena_database"])
+            athena.execute_sql(ddl, self.athena_client)
+            self._database_created = True
+
+    @property
+    def sort_by(self):
+        """Columns this stream's batches are sorted by before writing."""
+        columns = (self.config.get("sort_by") or {}).get(self.stream_name) or []
+        if isinstance(columns, str):
+            columns = [columns]
+        return columns
+
+    @property
+    def bucket_count(self):
+        """Number of hash buckets per flush, or None if the stream is not bucketed."""
+        if self.config.get("bucket_count") and self.bucket_by:
+            return self.config["bucket_count"]
+        return None
+
+    @property
+    def bucket_by(self):
+        """Columns rows are bucketed by, defaulting to the stream's key properties."""
+        columns = (self.config.get("bucket_by") or {}).get(self.stream_name)
+        if isinstance(columns, str):
+            columns = [columns]
+        return columns or self.key_properties or []
+
+    def _passthrough_enabled(self):
+        """Whether records of this stream can be written as the raw JSON text received."""
+        if not self.config.get("jsonl_passthrough"):
+            return False
+        blockers = [
+            name
+            for name, active in (
+                ("object_format", self.config.get("object_format") != "jsonl"),
+                ("flatten_records", self.config.get("flatten_records")),
+                ("add_record_metadata", self.config.get("add_record_metadata")),
+                ("stream_maps", self.config.get("stream_maps")),
+                ("dedupe_within_batch", self.config.get("dedupe_within_batch")),
+                ("sort_by", self.sort_by),
+                ("bucket_count", self.bucket_count),
+            )
+            if active
+        ]
+        if blockers:
+            self.logger.warning(
+                f"jsonl_passthrough is disabled for '{self.stream_name}' "
+                f"because of: {', '.join(blockers)}"
+            )
+            return False
+        return True
+
+    def _get_compression_level(self, compression_type):
+        if not compression_type:
+            return None
+        if not self.config.get("adaptive_compression"):
+            return self.config.get("compression_level")
+        if self._compression_tuner is None:
+            min_level, max_level = compression.LEVEL_BOUNDS[compression_type]
+            self._compression_tuner = compression.AdaptiveCompressionLevel(
+                self.config.get("compression_level_min") or min_level,
+                self.config.get("compression_level_max") or max_level,
+                level=(
+                    self.config.get("compression_level")
+                    or compression.DEFAULT_LEVELS[compression_type]
+                ),
+            )
+        return self._compression_tuner.level
+
     @staticmethod
     def _clean_table_name(stream_name):
         table_name_prefix = os.environ.get("TAP_NAME") + "_" if os.environ.get("TAP_NAME") else ""
         return (table_name_prefix + stream_name).replace("-", "_")
 
+    def process_raw_record(self, raw_record: str, context: dict) -> None:
+        """Buffer the raw JSON text of a record, validating every n-th one."""
+        self._raw_records_read += 1
+        validate_every_n = self.config.get("passthrough_validate_every_n")
+        if validate_every_n and (self._raw_records_read - 1) % validate_every_n == 0:
+            self._validate_and_parse(json.loads(raw_record))
+        self.process_record(raw_record, context)
+
+    def process_record(self, record: dict, context: dict) -> None:
+        if self.passthrough and isinstance(record, dict):
+            # Records that took the regular path join the raw ones as JSON
+            # text. The SDK has parsed their date-times, so write them the
+            # way coercion would rather than as Python reprs.
+            coercion.coerce_record(record, self._coercers)
+            record = json.dumps(record, default=str)
+        super().process_record(record, context)
+        if self._scheduler:
+            nbytes = utils.estimate_size(record)
+            self.buffered_bytes += nbytes
+            self._scheduler.track(nbytes)
+            if self.buffered_since is None:
+                self.buffered_since = time.monotonic()
+
+    def mark_drained(self) -> None:
+        super().mark_drained()
+        if self._scheduler:
+            self._scheduler.release(self.buffered_bytes)
+        self.buffered_bytes = 0
+        self.buffered_since = None
+
     def process_batch(self, context: dict) -> None:
         """Write any prepped records out and return only once fully written."""
-        # The SDK populates `context["records"]` automatically
-        # since we do not override `process_record()`.
-        records_to_drain = context["records"]
-        state = None
-        headers = {}
-        headers = self.schema["properties"].keys()
+        # `context["records"]` is filled by `process_record()`, which extends
+        # the SDK's to track buffered bytes and keep passthrough records raw.
+        retries_before = retry.get_policy().snapshot()
+        with self.profiler.batch() as profile:
+            with profile.stage("prepare"):
+                # Taken out of the context so that a spilling sort can free them
+                records_to_drain, record_count = self._prepare_records(context.pop("records"))
+            with profile.stage("write"):
+                batch_id = context.get("batch_id") or str(uuid.uuid4())
+                filenames = self._write_files(records_to_drain, batch_id)
+            with profile.stage("ddl"):
+                self._create_table()
+            with profile.stage("upload"):
+                self._upload_files(filenames, record_count)
 
-        object_format = self.config.get("object_format")
-        delimiter = self.config.get("delimiter", ",")
-        quotechar = self.config.get("quotechar", '"')
+        # Counters are process wide; batches drained in parallel show up too
+        retries = retry.get_policy().since(retries_before)
+        if any(counts.get("retries") for counts in retries.values()):
+            self.logger.info(f"Retry counters during this batch: {retries}")
 
+    @property
+    def temp_dir(self):
         # Use the system specific temp directory if no custom temp_dir provided
         temp_dir = os.path.expanduser(
             self.config.get("temp_dir", tempfile.gettempdir())
@@ -72,61 +207,132 @@ class AthenaSink(BatchSink):
         # Create temp_dir if not exists
         if temp_dir:
             os.makedirs(temp_dir, exist_ok=True)
+        return temp_dir
+
+    def _prepare_records(self, records_to_drain):
+        """Dedupe, coerce and sort a batch; return the records and their count."""
+        if self.passthrough:
+            # Raw JSON text, written as received
+            return records_to_drain, len(records_to_drain)
+        if self.config.get("dedupe_within_batch") and self.key_properties:
+            deduped_records = utils.dedupe_records(
+                records_to_drain,
+                self.key_properties,
+                order_by=self.config.get("dedupe_order_by"),
+            )
+            duplicates = len(records_to_drain) - len(deduped_records)
+            if duplicates:
+                self.logger.info(
+                    f"Dropped {duplicates} duplicate records from '{self.stream_name}' batch"
+                )
+                self.tally_duplicate_merged(duplicates)
+            records_to_drain = deduped_records
+        if self.config.get("coerce_types", True):
+            coercion.coerce_batch(records_to_drain, self._coercers)
+
+        record_count = len(records_to_drain)
+        if self.sort_by:
+            records_to_drain = sorting.sort_records(
+                records_to_drain,
+                self.sort_by,
+                max_rows_in_memory=(
+                    self.config.get("sort_max_rows_in_memory")
+                    or sorting.DEFAULT_MAX_ROWS_IN_MEMORY
+                ),
+                temp_dir=self.temp_dir,
+            )
+        return records_to_drain, record_count
+
+    def _write_files(self, records_to_drain, batch_id):
+        """Serialize records to local files; return `(filename, target_key)` pairs."""
+        object_format = self.config.get("object_format")
+        delimiter = self.config.get("delimiter", ",")
+        quotechar = self.config.get("quotechar", '"')
+        temp_dir = self.temp_dir
 
         filenames = []
-        now = datetime.now().strftime("%Y%m%dT%H%M%S")
+        # Several batches of a stream can be drained within the same second,
+        # so the batch id keeps their file names apart.
+        now = datetime.now().strftime("%Y%m%dT%H%M%S") + "-" + batch_id[:8]
 
-        # Serialize records to local files
-        for record in records_to_drain:
-            filename = self.stream_name + "-" + now + "." + object_format
-            filename = os.path.expanduser(os.path.join(temp_dir, filename))
-            s3_prefix = "{prefix}{database}/".format(
-                prefix=self.config.get("s3_key_prefix", ""),
-                database=self.config.get("athena_database", "")
+        s3_prefix = "{prefix}{database}/".format(
+            prefix=self.config.get("s3_key_prefix", ""),
+            database=self.config.get("athena_database", "")
+        )
+        if self.bucket_count:
+            groups = bucketing.group_by_bucket(
+                records_to_drain, self.bucket_by, self.bucket_count, object_format
+            )
+        else:
+            groups = {None: records_to_drain}
+
+        if object_format == 'csv':
+            if self.config.get("flatten_records"):
+                groups = {
+                    bucket: [utils.flatten_record(record, schema=self.schema["properties"]) for record in records]
+                    for bucket, records in groups.items()
+                }
+            csv_writer = formats.CSVWriter(
+                self.columns,
+                delimiter=delimiter,
+                quotechar=quotechar,
             )
+
+        # Serialize records to local files, one per bucket
+        for bucket, records in groups.items():
+            name = now if bucket is None else f"{now}-{bucket:06d}"
+            filename = self.stream_name + "-" + name + "." + object_format
+            filename = os.path.expanduser(os.path.join(temp_dir, filename))
             target_key = utils.get_target_key(
                 self.stream_name,
                 object_format,
                 prefix=s3_prefix,
                 timestamp=now,
                 # naming_convention=self.config.get("naming_convention"),
+                bucket=bucket,
+                shards=self.config.get("s3_key_shards"),
             )
-            if not (filename, target_key) in filenames:
-                filenames.append((filename, target_key))
+            if self.passthrough:
+                if records:
+                    filenames.append((filename, target_key))
+                    formats.write_jsonl_lines(filename, records)
+                continue
+            if object_format == 'csv':
+                if csv_writer.write(filename, records):
+                    filenames.append((filename, target_key))
+                continue
+            for record in records:
+                if not filenames or filenames[-1] != (filename, target_key):
+                    filenames.append((filename, target_key))
 
-            file_is_empty = (not os.path.isfile(filename)) or os.stat(
-                filename
-            ).st_size == 0
+                if self.config.get("flatten_records"):
+                    flattened_record = utils.flatten_record(record, schema=self.schema["properties"])
+                else:
+                    flattened_record = record
 
-            if self.config.get("flatten_records"):
-                flattened_record = utils.flatten_record(record)
-            else:
-                flattened_record = record
+                if object_format == 'jsonl':
+                    formats.write_jsonl(
+                        filename = filename,
+                        record = flattened_record
+                    )
+                else:
+                    self.logger.warn(f"Unrecognized format: '{object_format}'")
+        return filenames
 
-            if object_format == 'csv':
-                formats.write_csv(
-                    filename = filename,
-                    record = flattened_record,
-                    header = headers,
-                    delimiter = delimiter,
-                    quotechar = quotechar
-                )
-            elif object_format == 'jsonl':
-                formats.write_jsonl(
-                    filename = filename,
-                    record = flattened_record
-                )
-            else:
-                self.logger.warn(f"Unrecognized format: '{object_format}'")
+    def _create_table(self):
+        """Create the stream's table in Athena, once per sink."""
+        if self._table_created:
+            return
+        headers = self.columns
+        object_format = self.config.get("object_format")
 
         # Create schemas in Athena
         self.logger.info("headers: {}".format(headers))
-        data_location = "s3://{s3_bucket}/{key_prefix}{database}/{stream}/".format(
-            s3_bucket=self.config.get("s3_bucket"),
+        data_location = self.storage.uri("{key_prefix}{database}/{stream}/".format(
             key_prefix=self.config.get("s3_key_prefix", ""),
             database=self.config.get("athena_database",""),
             stream=self.stream_name,
-        )  # TODO: double check this
+        ))  # TODO: double check this
         if object_format == 'csv':
             ddl = athena.generate_create_table_ddl(
                 self._clean_table_name(self.stream_name),
@@ -135,6 +341,8 @@ class AthenaSink(BatchSink):
                 database=self.config.get("athena_database"),
                 data_location=data_location,
                 row_format="org.apache.hadoop.hive.serde2.OpenCSVSerde",
+                bucket_by=self.bucket_by,
+                bucket_count=self.bucket_count,
             )
         elif object_format == 'jsonl':
             ddl = athena.generate_create_table_ddl(
@@ -145,47 +353,58 @@ class AthenaSink(BatchSink):
                 data_location=data_location,
                 skip_header=False,
                 row_format="org.openx.data.jsonserde.JsonSerDe",
-                serdeproperties="'ignore.malformed.json'='true', 'case.insensitive'='true'"
+                serdeproperties="'ignore.malformed.json'='true', 'case.insensitive'='true'",
+                bucket_by=self.bucket_by,
+                bucket_count=self.bucket_count,
             )
         else:
             self.logger.warn(f"Unrecognized format: '{object_format}'")
         self.logger.info(ddl)
         self.logger.info(data_location)
-        athena.execute_sql(ddl, self.athena_client)
+        if self.storage.athena_compatible:
+            self._ensure_database()
+            athena.execute_sql(ddl, self.athena_client)
+        self._table_created = True
 
-        # Upload created files to S3
+    def _upload_files(self, filenames, record_count):
+        """Compress and upload local files to storage, then remove them."""
+        # Upload created files to storage
+        compression_type = compression.get_compression(self.config)
+        compression_level = self._get_compression_level(compression_type)
+        compress_seconds = upload_seconds = 0.0
+        uncompressed_bytes = uploaded_bytes = 0
         for filename, target_key in filenames:
             compressed_file = None
-            if (
-                self.config.get("compression") is None
-                or self.config["compression"].lower() == "none"
-            ):
-                pass  # no compression
-            else:
-                if self.config["compression"] == "gzip":
-                    compressed_file = f"{filename}.gz"
-                    target_key = target_key + ".gz"
-                    with open(filename, "rb") as f_in:
-                        with gzip.open(compressed_file, "wb") as f_out:
-                            self.logger.info(f"Compressing file as '{compressed_file}'")
-                            shutil.copyfileobj(f_in, f_out)
-                else:
-                    raise NotImplementedError(
-                        "Compression type '{}' is not supported. "
-                        "Expected: 'none' or 'gzip'".format(self.config["compression"])
-                    )
-            s3.upload_file(
-                compressed_file or filename,
-                self.s3_client,
-                self.config.get("s3_bucket"),
-                target_key,
-                encryption_type=self.config.get("encryption_type"),
-                encryption_key=self.config.get("encryption_key"),
-            )
+            started_at = time.perf_counter()
+            if compression_type:
+                compressed_file = compression.compress_file(
+                    filename, compression_type, compression_level
+                )
+                self.logger.info(f"Compressed file as '{compressed_file}'")
+                target_key = target_key + compression.EXTENSIONS[compression_type]
+            compressed_at = time.perf_counter()
+            self.storage.upload(compressed_file or filename, target_key)
+            uploaded_at = time.perf_counter()
+
+            compress_seconds += compressed_at - started_at
+            upload_seconds += uploaded_at - compressed_at
+            uncompressed_bytes += os.path.getsize(filename)
+            uploaded_bytes += os.path.getsize(compressed_file or filename)
 
             # Remove the local file(s)
             os.remove(filename)
             if compressed_file:
                 os.remove(compressed_file)
 
-        return state
+        if self._compression_tuner and compress_seconds and upload_seconds:
+            next_level = self._compression_tuner.record(
+                record_count, compress_seconds, upload_seconds
+            )
+            self.logger.info(
+                f"Compression level {compression_level} for '{self.stream_name}': "
+                f"compressed {uncompressed_bytes / compress_seconds / 1e6:.1f} MB/s, "
+                f"uploaded {uploaded_bytes / upload_seconds / 1e6:.1f} MB/s, "
+                f"{record_count / (compress_seconds + upload_seconds):.0f} records/s. "
+                f"Next compression level: {next_level}"
+            )
+
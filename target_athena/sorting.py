@@ -0,0 +1,104 @@
+"""Clustered sorting of record batches, spilling to disk for large batches."""
+
+import datetime
+import decimal
+import heapq
+import itertools
+import json
+import pickle
+import tempfile
+
+DEFAULT_MAX_ROWS_IN_MEMORY = 100000
+
+
+def _comparable(value):
+    """Rank a value by type so that values of different types compare too."""
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, datetime.datetime):
+        # Naive and timezone aware datetimes can't be compared with each other
+        return (4, value.tzinfo is not None, value)
+    if isinstance(value, datetime.date):
+        return (5, value)
+    return (6, json.dumps(value, sort_keys=True, default=str))
+
+
+def sort_key(columns):
+    """Return a key function ordering records by `columns`, nulls first.
+
+    Values of different types in a column, e.g. of a union type, are ordered
+    by type: booleans, numbers, strings, datetimes, dates, then anything else
+    by its JSON text.
+    """
+    def key(record):
+        values = []
+        for column in columns:
+            value = record.get(column)
+            values.append((0,) if value is None else _comparable(value))
+        return tuple(values)
+    return key
+
+
+def _spill(records, temp_dir):
+    run = tempfile.TemporaryFile(dir=temp_dir)
+    pickler = pickle.Pickler(run, protocol=pickle.HIGHEST_PROTOCOL)
+    for record in records:
+        pickler.dump(record)
+        # Records are independent; don't let the memo keep them alive.
+        pickler.clear_memo()
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    unpickler = pickle.Unpickler(run)
+    try:
+        while True:
+            yield unpickler.load()
+    except EOFError:
+        run.close()
+
+
+def _take_chunks(records, size):
+    """Yield lists of up to `size` records; a list is emptied as they are taken."""
+    if isinstance(records, list):
+        while records:
+            chunk = records[:size]
+            del records[:size]
+            yield chunk
+        return
+    records = iter(records)
+    chunk = list(itertools.islice(records, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(records, size))
+
+
+def sort_records(records, columns, max_rows_in_memory=DEFAULT_MAX_ROWS_IN_MEMORY, temp_dir=None):
+    """Sort records by `columns`, returning an iterator over the sorted records.
+
+    Up to `max_rows_in_memory` records are sorted in memory. Larger inputs are
+    sorted in runs of that size, spilled to temporary files and lazily
+    merged back.
+
+    A list of records is emptied as its runs are taken, so that spilled
+    records can be freed as long as nothing else references them. Callers
+    holding the batch elsewhere (such as the SDK's `context["records"]`)
+    must drop that reference for spilling to lower peak memory.
+    """
+    key = sort_key(columns)
+    runs = []
+    pending = None
+    for chunk in _take_chunks(records, max_rows_in_memory):
+        chunk.sort(key=key)
+        if pending is not None:
+            runs.append(_spill(pending, temp_dir))
+        pending = chunk
+    if not runs:
+        return iter(pending or [])
+    runs.append(_spill(pending, temp_dir))
+    return heapq.merge(*(_read_run(run) for run in runs), key=key)
@@ -0,0 +1,189 @@
+"""Storage backends that data files are uploaded to."""
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+from target_athena import s3
+
+DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+DEFAULT_MULTIPART_CONCURRENCY = 4
+
+
+class StorageBackend:
+    """Interface for an object store holding the table data files.
+
+    Keys are always `/`-separated, relative to the root of the store.
+    """
+
+    # Whether tables over this storage can be registered in Athena.
+    athena_compatible = False
+
+    def __init__(
+        self,
+        multipart_threshold=DEFAULT_MULTIPART_THRESHOLD,
+        multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+        multipart_concurrency=DEFAULT_MULTIPART_CONCURRENCY,
+    ):
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.multipart_concurrency = multipart_concurrency
+
+    def put(self, filename, key):
+        """Store a local file under `key` in a single request."""
+        raise NotImplementedError
+
+    def multipart(self, filename, key, part_size):
+        """Store a local file under `key` in parts of `part_size` bytes."""
+        raise NotImplementedError
+
+    def head(self, key):
+        """Return a dict with `size` and `last_modified` for `key`, or None."""
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        """Yield every key starting with `prefix`."""
+        raise NotImplementedError
+
+    def uri(self, key):
+        """Return the location URI of `key`, as used in a table LOCATION."""
+        raise NotImplementedError
+
+    def upload(self, filename, key):
+        """Store a local file, switching to a multipart upload for large files."""
+        if os.path.getsize(filename) >= self.multipart_threshold:
+            self.multipart(filename, key, self.multipart_chunksize)
+        else:
+            self.put(filename, key)
+
+
+class S3Storage(StorageBackend):
+    """Amazon S3 storage."""
+
+    athena_compatible = True
+
+    def __init__(self, config, **kwargs):
+        super().__init__(**kwargs)
+        self.config = config
+        self.bucket = config.get("s3_bucket")
+        self.encryption_type = config.get("encryption_type")
+        self.encryption_key = config.get("encryption_key")
+        self._client = None
+
+    @property
+    def client(self):
+        if not self._client:
+            self._client = s3.create_client(self.config)
+        return self._client
+
+    def put(self, filename, key):
+        s3.upload_file(
+            filename,
+            self.client,
+            self.bucket,
+            key,
+            encryption_type=self.encryption_type,
+            encryption_key=self.encryption_key,
+        )
+
+    def multipart(self, filename, key, part_size):
+        s3.upload_file_multipart(
+            filename,
+            self.client,
+            self.bucket,
+            key,
+            part_size,
+            encryption_type=self.encryption_type,
+            encryption_key=self.encryption_key,
+            max_concurrency=self.multipart_concurrency,
+        )
+
+    def head(self, key):
+        return s3.head_object(self.client, self.bucket, key)
+
+    def list(self, prefix=""):
+        return s3.list_keys(self.client, self.bucket, prefix)
+
+    def uri(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+
+class LocalStorage(StorageBackend):
+    """Local (or network mounted) filesystem storage under a root directory.
+
+    Files are written to a temporary name next to their destination and
+    renamed into place, so readers never see a partially written file.
+    """
+
+    def __init__(self, root, **kwargs):
+        super().__init__(**kwargs)
+        self.root = os.path.abspath(os.path.expanduser(root))
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def _write(self, filename, key, part_size):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with open(filename, "rb") as f_in, os.fdopen(fd, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, part_size)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def put(self, filename, key):
+        self._write(filename, key, DEFAULT_MULTIPART_CHUNKSIZE)
+
+    def multipart(self, filename, key, part_size):
+        self._write(filename, key, part_size)
+
+    def head(self, key):
+        try:
+            stat = os.stat(self._path(key))
+        except FileNotFoundError:
+            return None
+        return {
+            "size": stat.st_size,
+            "last_modified": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+        }
+
+    def list(self, prefix=""):
+        for dirpath, _, filenames in os.walk(self.root):
+            relative_dir = os.path.relpath(dirpath, self.root)
+            for name in sorted(filenames):
+                if name.endswith(".tmp"):
+                    continue
+                if relative_dir == ".":
+                    key = name
+                else:
+                    key = "/".join(relative_dir.split(os.sep) + [name])
+                if key.startswith(prefix):
+                    yield key
+
+    def uri(self, key):
+        return "file://" + self._path(key)
+
+
+def create_backend(config):
+    """Create the storage backend selected by the `storage_backend` setting."""
+    backend = (config.get("storage_backend") or "s3").lower()
+    kwargs = {
+        "multipart_threshold": config.get("multipart_threshold") or DEFAULT_MULTIPART_THRESHOLD,
+        "multipart_chunksize": config.get("multipart_chunksize") or DEFAULT_MULTIPART_CHUNKSIZE,
+        "multipart_concurrency": config.get("multipart_concurrency") or DEFAULT_MULTIPART_CONCURRENCY,
+    }
+    if backend == "s3":
+        return S3Storage(config, **kwargs)
+    if backend == "local":
+        if not config.get("storage_root"):
+            raise ValueError("The 'local' storage backend requires 'storage_root'.")
+        return LocalStorage(config["storage_root"], **kwargs)
+    raise NotImplementedError(
+        "Storage backend '{}' is not supported. "
+        "Expected: 's3' or 'local'".format(backend)
+    )
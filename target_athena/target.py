@@ -1,8 +1,14 @@
 """Athena target class."""
 
+import click
+from singer_sdk.exceptions import ConfigValidationError
 from singer_sdk.target_base import Target
 from singer_sdk import typing as th
 
+from target_athena import backfill
+from target_athena import passthrough
+from target_athena import retry
+from target_athena import scheduler
 from target_athena.sinks import (
     AthenaSink,
 )
@@ -13,17 +19,22 @@ class TargetAthena(Target):
 
     name = "target-athena"
     config_jsonschema = th.PropertiesList(
-        th.Property("s3_bucket", th.StringType, required=True),
+        th.Property("s3_bucket", th.StringType),
         th.Property("athena_database", th.StringType, required=True),
-        th.Property("aws_region", th.StringType, required=True),
+        th.Property("aws_region", th.StringType),
         th.Property("aws_access_key_id", th.StringType),
         th.Property("aws_secret_access_key", th.StringType),
         th.Property("aws_session_token", th.StringType),
         th.Property("aws_profile", th.StringType),
         th.Property("s3_key_prefix", th.StringType),
         th.Property("naming_convention", th.StringType),
+        th.Property("s3_key_shards", th.IntegerType),
         th.Property("object_format", th.StringType, default='jsonl'),
         th.Property("compression", th.StringType, default='gzip'),
+        th.Property("compression_level", th.IntegerType),
+        th.Property("adaptive_compression", th.BooleanType, default=False),
+        th.Property("compression_level_min", th.IntegerType),
+        th.Property("compression_level_max", th.IntegerType),
         th.Property("encryption_type", th.StringType),
         th.Property("encryption_key", th.StringType),
         th.Property("add_record_metadata", th.BooleanType, default=False),
@@ -31,10 +42,119 @@ class TargetAthena(Target):
         th.Property("delimiter", th.StringType, default=","),
         th.Property("quotechar", th.StringType, default='"'),
         th.Property("temp_dir", th.StringType),
+        th.Property("max_buffer_bytes", th.IntegerType),
+        th.Property("drain_policy", th.StringType, default="largest"),
+        th.Property("retry_max_attempts", th.IntegerType),
+        th.Property("retry_base_delay", th.NumberType),
+        th.Property("retry_max_delay", th.NumberType),
+        th.Property("retry_max_total_delay", th.NumberType),
+        th.Property("storage_backend", th.StringType, default="s3"),
+        th.Property("storage_root", th.StringType),
+        th.Property("multipart_threshold", th.IntegerType),
+        th.Property("multipart_chunksize", th.IntegerType),
+        th.Property("multipart_concurrency", th.IntegerType),
+        th.Property("dedupe_within_batch", th.BooleanType, default=False),
+        th.Property("dedupe_order_by", th.StringType),
+        th.Property("coerce_types", th.BooleanType, default=True),
+        th.Property("sort_by", th.ObjectType()),
+        th.Property("sort_max_rows_in_memory", th.IntegerType),
+        th.Property("bucket_by", th.ObjectType()),
+        th.Property("bucket_count", th.IntegerType),
+        th.Property("jsonl_passthrough", th.BooleanType, default=False),
+        th.Property("passthrough_validate_every_n", th.IntegerType, default=100),
+        th.Property("profile_dir", th.StringType),
+        th.Property("profile_every_n_batches", th.IntegerType, default=10),
+        th.Property("profile_top_n", th.IntegerType, default=25),
         th.Property("stream_maps", th.ObjectType()),
         th.Property("stream_map_config", th.ObjectType()),
     ).to_dict()
     default_sink_class = AthenaSink
 
+    # Settings required by the `s3` storage backend only
+    S3_REQUIRED_SETTINGS = ("s3_bucket", "aws_region")
 
-cli = TargetAthena.cli
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        retry.configure(self.config)
+        self.scheduler = scheduler.MemoryBudgetScheduler.from_config(self.config)
+
+    def _validate_config(self, raise_errors=True, warnings_as_errors=False):
+        warnings, errors = super()._validate_config(raise_errors, warnings_as_errors)
+        if (self.config.get("storage_backend") or "s3") == "s3":
+            missing = [key for key in self.S3_REQUIRED_SETTINGS if not self.config.get(key)]
+            if missing:
+                summary = (
+                    f"Config validation failed: {', '.join(missing)} required "
+                    "by the 's3' storage backend"
+                )
+                if raise_errors:
+                    raise ConfigValidationError(summary)
+                self.logger.warning(summary)
+                errors.append(summary)
+        return warnings, errors
+
+    def _process_lines(self, input):
+        if self.config.get("jsonl_passthrough"):
+            input = self._passthrough_lines(input)
+        return super()._process_lines(input)
+
+    def _passthrough_lines(self, lines):
+        """Buffer RECORD lines of passthrough streams raw; yield all other lines."""
+        for line in lines:
+            if '"RECORD"' in line:
+                split = passthrough.split_record_line(line)
+                if split:
+                    stream_name, raw_record = split
+                    sink = self._sinks_active.get(stream_name)
+                    if sink is not None and sink.passthrough:
+                        self._process_raw_record(sink, raw_record)
+                        continue
+            yield line
+
+    def _process_raw_record(self, sink, raw_record: str) -> None:
+        context = sink._get_context(None)
+        sink.tally_record_read()
+        sink.process_raw_record(raw_record, context)
+        sink._after_process_record(context)
+        if sink.is_full:
+            self.logger.info(
+                f"Target sink for '{sink.stream_name}' is full. Draining..."
+            )
+            self.drain_one(sink)
+        self._drain_over_budget()
+
+    def _process_record_message(self, message_dict: dict) -> None:
+        super()._process_record_message(message_dict)
+        self._drain_over_budget()
+
+    def _drain_over_budget(self) -> None:
+        if self.scheduler and self.scheduler.over_budget:
+            sinks = self._sinks_to_clear + list(self._sinks_active.values())
+            for sink in self.scheduler.select(sinks):
+                self.logger.info(
+                    f"Buffered records exceed max_buffer_bytes. Draining "
+                    f"'{sink.stream_name}' ({sink.buffered_bytes} bytes)..."
+                )
+                self.drain_one(sink)
+
+
+class _TargetGroup(click.Group):
+    """Runs the target unless the first argument names a subcommand."""
+
+    def parse_args(self, ctx, args):
+        # `--help` alone describes the group, listing the subcommands
+        passthrough_args = set(self.commands) | set(self.get_help_option_names(ctx))
+        if not args or args[0] not in passthrough_args:
+            args = ["run"] + list(args)
+        return super().parse_args(ctx, args)
+
+
+cli = _TargetGroup(
+    help=(
+        "Execute the Singer target, or run one of its subcommands. Without a "
+        "subcommand, the options are those of `run`."
+    ),
+    context_settings={"help_option_names": ["--help"]},
+)
+cli.add_command(TargetAthena.cli, "run")
+cli.add_command(backfill.backfill)
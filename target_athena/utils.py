@@ -1,27 +1,15 @@
 from datetime import datetime
 import time
-import singer
+import hashlib
 import json
+import logging
 import re
+import sys
 import collections
-import inflection
 
-from decimal import Decimal
 from datetime import datetime
 
-logger = singer.get_logger("target_athena")
-
-
-def float_to_decimal(value):
-    """Walk the given data structure and turn all instances of float into
-    double."""
-    if isinstance(value, float):
-        return Decimal(str(value))
-    if isinstance(value, list):
-        return [float_to_decimal(child) for child in value]
-    if isinstance(value, dict):
-        return {k: float_to_decimal(v) for k, v in value.items()}
-    return value
+logger = logging.getLogger("target_athena")
 
 
 # pylint: disable=unnecessary-comprehension
@@ -31,6 +19,7 @@ def flatten_key(k, parent_key, sep):
     inflected_key = [n for n in full_key]
     reducer_index = 0
     while len(sep.join(inflected_key)) >= 255 and reducer_index < len(inflected_key):
+        import inflection  # only needed for overlong keys
         reduced_key = re.sub(
             r"[a-z]", "", inflection.camelize(inflected_key[reducer_index])
         )
@@ -42,25 +31,142 @@ def flatten_key(k, parent_key, sep):
     return sep.join(inflected_key)
 
 
-def flatten_record(d, parent_key=[], sep="__"):
-    """"""
+def _declared_properties(prop):
+    """Return the declared properties of an object schema, or None."""
+    prop = prop or {}
+    types = prop.get("type", [])
+    if isinstance(types, str):
+        types = [types]
+    if "object" in types and prop.get("properties"):
+        return prop["properties"]
+    return None
+
+
+def flatten_record(d, parent_key=[], sep="__", schema=None):
+    """Flatten nested objects into `parent__child` keys.
+
+    With `schema` (the `properties` of the record's schema), only objects with
+    declared properties are expanded, so that the keys are those of
+    `flatten_schema_columns`; other objects are kept as JSON text.
+    """
     items = []
     for k in sorted(d.keys()):
         v = d[k]
         new_key = flatten_key(k, parent_key, sep)
-        if isinstance(v, collections.MutableMapping):
+        if schema is not None and k in schema and isinstance(v, collections.MutableMapping):
+            properties = _declared_properties(schema[k])
+            if properties is None:
+                items.append((new_key, json.dumps(v, default=str)))
+            else:
+                items.extend(flatten_record(v, parent_key + [k], sep=sep, schema=properties).items())
+        elif isinstance(v, collections.MutableMapping):
             items.extend(flatten_record(v, parent_key + [k], sep=sep).items())
         else:
             items.append((new_key, json.dumps(v) if type(v) is list else v))
     return dict(items)
 
 
-def get_target_key(stream_name, object_format, prefix="", timestamp=None, naming_convention=None):
+def flatten_schema_columns(properties, parent_key=[], sep="__"):
+    """Return the columns `flatten_record` gives records of a schema, in the same order.
+
+    Objects are expanded through their declared `properties`; objects without
+    declared properties stay a single column, holding their JSON text when
+    records are flattened with the same schema.
+    """
+    columns = []
+    for k in sorted(properties.keys()):
+        nested = _declared_properties(properties[k])
+        if nested is not None:
+            columns.extend(flatten_schema_columns(nested, parent_key + [k], sep=sep))
+        else:
+            columns.append(flatten_key(k, parent_key, sep))
+    return columns
+
+
+def estimate_size(value):
+    """Approximate the in-memory size, in bytes, of a decoded JSON value."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for item in value.values():
+            size += estimate_size(item)
+    elif isinstance(value, list):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
+
+def dedupe_records(records, key_properties, order_by=None):
+    """Keep only the latest version of each primary key within a batch.
+
+    Records are indexed by the tuple of their `key_properties` values. When
+    `order_by` is given, the record with the greatest value in that column wins
+    (nulls lose to any value); otherwise the last record received wins, as it
+    also does when the two `order_by` values can't be compared. Records missing
+    a key value, or with a null one, are passed through untouched.
+
+    Args:
+        records (list): Records of one batch, in arrival order.
+        key_properties (list): Primary key columns of the stream.
+        order_by (str, optional): Column used to pick the latest version.
+
+    Returns:
+        list: The surviving records, in the order they were first seen.
+    """
+    index = {}
+    passthrough = []
+    for position, record in enumerate(records):
+        try:
+            key = tuple(record[k] for k in key_properties)
+            hash(key)
+        except (KeyError, TypeError):
+            key = None
+        if key is None or None in key:
+            passthrough.append((position, record))
+            continue
+        current = index.get(key)
+        if current is None:
+            index[key] = (position, record)
+        elif order_by is None:
+            index[key] = (current[0], record)
+        else:
+            new_value = record.get(order_by)
+            old_value = current[1].get(order_by)
+            try:
+                newer = old_value is None or (new_value is not None and new_value >= old_value)
+            except TypeError:
+                # e.g. naive and timezone aware datetimes
+                newer = True
+            if newer:
+                index[key] = (current[0], record)
+
+    if not passthrough:
+        return [record for _, record in index.values()]
+    survivors = sorted(list(index.values()) + passthrough, key=lambda item: item[0])
+    return [record for _, record in survivors]
+
+
+def key_shard(name, shards):
+    """Return the hex shard prefix `name` hashes to, out of `shards` shards."""
+    width = len(format(shards - 1, "x"))
+    shard = int(hashlib.md5(name.encode("utf-8")).hexdigest(), 16) % shards
+    return format(shard, "0{}x".format(width))
+
+
+def get_target_key(stream_name, object_format, prefix="", timestamp=None, naming_convention=None, bucket=None, shards=None):
     """Creates and returns an S3 key for the message"""
 
     if not timestamp:
         timestamp = datetime.now().strftime("%Y%m%dT%H%M%S")
 
-    key = f"{prefix}{stream_name}/{timestamp}.{object_format}"
+    if bucket is not None:
+        # Athena reads the bucket number from the leading digits of the file name
+        key = f"{prefix}{stream_name}/{bucket:06d}_0_{timestamp}.{object_format}"
+    elif shards and shards > 1:
+        # S3 scales request rates per key prefix, so a hashed shard leading the
+        # file name spreads a stream's objects while keeping them in its location.
+        shard = key_shard(f"{stream_name}/{timestamp}", shards)
+        key = f"{prefix}{stream_name}/{shard}-{timestamp}.{object_format}"
+    else:
+        key = f"{prefix}{stream_name}/{timestamp}.{object_format}"
 
     return key 
@@ -0,0 +1,97 @@
+"""Startup benchmark: time from interpreter start to the first buffered record.
+
+Each run happens in a fresh interpreter so module import costs are measured
+cold. No AWS access is needed: nothing touches the network until the first
+drain, and the benchmark stops before draining.
+
+Usage:
+    python tests/benchmarks/bench_startup.py [--runs N]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ["boto3", "botocore", "pyathena", "singer", "inflection", "backoff"]
+
+RUN_ONCE = r"""
+import io
+import json
+import sys
+import time
+
+t0 = time.perf_counter()
+import target_athena.sinks
+from target_athena.target import TargetAthena
+t_import = time.perf_counter()
+
+target = TargetAthena(
+    config={
+        "s3_bucket": "benchmark",
+        "athena_database": "benchmark",
+        "aws_region": "us-east-1",
+    }
+)
+t_target = time.perf_counter()
+
+lines = [
+    json.dumps({
+        "type": "SCHEMA",
+        "stream": "bench",
+        "schema": {"properties": {"id": {"type": "integer"}}},
+        "key_properties": ["id"],
+    }),
+    json.dumps({"type": "RECORD", "stream": "bench", "record": {"id": 1}}),
+]
+target._process_lines(io.StringIO("\n".join(lines) + "\n"))
+t_record = time.perf_counter()
+
+sink = target._sinks_active["bench"]
+assert sink.current_size == 1
+
+print(json.dumps({
+    "import": t_import - t0,
+    "target": t_target - t_import,
+    "first_record": t_record - t0,
+    "heavy_modules": sorted(m for m in %r if m in sys.modules),
+    "network_clients": bool(sink._athena_client or sink._storage),
+}))
+""" % (HEAVY_MODULES,)
+
+
+def run_once():
+    output = subprocess.run(
+        [sys.executable, "-c", RUN_ONCE],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    for metric in ("import", "target", "first_record"):
+        values = [r[metric] for r in results]
+        print(
+            "{:<14} median {:8.1f} ms   min {:8.1f} ms".format(
+                metric, statistics.median(values) * 1000, min(values) * 1000
+            )
+        )
+    print("heavy modules loaded before first drain: {}".format(
+        ", ".join(results[-1]["heavy_modules"]) or "none"
+    ))
+    print("network clients created before first drain: {}".format(
+        results[-1]["network_clients"]
+    ))
+
+
+if __name__ == "__main__":
+    main()
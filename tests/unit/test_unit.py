@@ -1,7 +1,26 @@
+from datetime import datetime, timezone
+import os
+import pstats
+import tempfile
 import unittest
 from nose.tools import assert_raises
+from singer_sdk.exceptions import ConfigValidationError
 
-import target_athena
+import target_athena.athena
+import target_athena.s3
+import target_athena.utils
+from target_athena import coercion
+from target_athena.backfill import expand_inputs, is_singer_message, load_schema
+from target_athena.bucketing import bucket_of, hive_string_hash
+from target_athena.passthrough import split_record_line
+from target_athena.profiling import BatchProfiler
+from target_athena.compression import AdaptiveCompressionLevel
+from target_athena.formats import CSVWriter
+from target_athena.retry import RetryPolicy
+from target_athena.scheduler import MemoryBudgetScheduler
+from target_athena.sorting import sort_records
+from target_athena.storage import LocalStorage
+from target_athena.target import TargetAthena
 
 class TestUnit(unittest.TestCase):
     """
@@ -46,3 +65,385 @@ class TestUnit(unittest.TestCase):
         s3_key = target_athena.utils.get_target_key(stream_name, prefix='the_prefix__', naming_convention='folder1/test_{stream}_test.csv')
 
         self.assertEqual('folder1/the_prefix__test_the_stream_test.csv', s3_key)
+
+
+    def test_dedupe_records_keeps_last_version(self):
+        """Test that only the last record received per key is kept"""
+        records = [
+            {'id': 1, 'name': 'a'},
+            {'id': 2, 'name': 'b'},
+            {'id': 1, 'name': 'c'},
+        ]
+        deduped = target_athena.utils.dedupe_records(records, ['id'])
+
+        self.assertEqual([{'id': 1, 'name': 'c'}, {'id': 2, 'name': 'b'}], deduped)
+
+
+    def test_dedupe_records_honors_order_by(self):
+        """Test that the record with the greatest ordering value is kept"""
+        records = [
+            {'id': 1, 'updated_at': '2021-01-02', 'name': 'a'},
+            {'id': 1, 'updated_at': '2021-01-01', 'name': 'b'},
+            {'id': 1, 'updated_at': None, 'name': 'c'},
+        ]
+        deduped = target_athena.utils.dedupe_records(records, ['id'], order_by='updated_at')
+
+        self.assertEqual([{'id': 1, 'updated_at': '2021-01-02', 'name': 'a'}], deduped)
+
+
+    def test_dedupe_records_passes_through_null_keys(self):
+        """Test that records with a null key are kept and incomparable versions don't raise"""
+        records = [
+            {'id': None, 'v': 1},
+            {'id': 1, 'updated_at': datetime(2021, 1, 2), 'v': 2},
+            {'id': None, 'v': 3},
+            {'id': 1, 'updated_at': datetime(2021, 1, 1, tzinfo=timezone.utc), 'v': 4},
+        ]
+        deduped = target_athena.utils.dedupe_records(records, ['id'], order_by='updated_at')
+
+        self.assertEqual([1, 4, 3], [record['v'] for record in deduped])
+
+
+    def test_local_storage_round_trip(self):
+        """Test that the local storage backend writes, describes and lists files"""
+        with tempfile.TemporaryDirectory() as root:
+            source = os.path.join(root, 'source.jsonl')
+            with open(source, 'w') as f:
+                f.write('{"id": 1}\n' * 100)
+            backend = LocalStorage(os.path.join(root, 'store'))
+
+            backend.put(source, 'db/stream/a.jsonl')
+            backend.multipart(source, 'db/stream/b.jsonl', part_size=7)
+
+            self.assertEqual(os.path.getsize(source), backend.head('db/stream/b.jsonl')['size'])
+            self.assertIsNone(backend.head('db/stream/c.jsonl'))
+            self.assertEqual(['db/stream/a.jsonl', 'db/stream/b.jsonl'], sorted(backend.list('db/')))
+            self.assertEqual([], list(backend.list('other/')))
+
+
+    def test_multipart_upload_sends_parts_in_parallel_and_in_order(self):
+        """Test that multipart uploads complete with every part in order, and abort on failure"""
+        class FakeClient:
+            def __init__(self, fail_part=None):
+                self.fail_part = fail_part
+                self.bodies = {}
+                self.completed = self.aborted = None
+
+            def create_multipart_upload(self, **kwargs):
+                return {'UploadId': 'u'}
+
+            def upload_part(self, PartNumber, Body, **kwargs):
+                if PartNumber == self.fail_part:
+                    raise RuntimeError('part failed')
+                self.bodies[PartNumber] = Body
+                return {'ETag': f'e{PartNumber}'}
+
+            def complete_multipart_upload(self, MultipartUpload, **kwargs):
+                self.completed = MultipartUpload['Parts']
+
+            def abort_multipart_upload(self, UploadId, **kwargs):
+                self.aborted = UploadId
+
+        with tempfile.TemporaryDirectory() as root:
+            source = os.path.join(root, 'source.jsonl')
+            with open(source, 'wb') as f:
+                f.write(bytes(range(100)) * 10)
+
+            client = FakeClient()
+            target_athena.s3.upload_file_multipart(source, client, 'b', 'k', 64, max_concurrency=4)
+            self.assertEqual([{'ETag': f'e{n}', 'PartNumber': n} for n in range(1, 17)], client.completed)
+            self.assertEqual(bytes(range(100)) * 10, b''.join(client.bodies[n] for n in range(1, 17)))
+
+            client = FakeClient(fail_part=3)
+            with assert_raises(RuntimeError):
+                target_athena.s3.upload_file_multipart(source, client, 'b', 'k', 64, max_concurrency=4)
+            self.assertIsNone(client.completed)
+            self.assertEqual('u', client.aborted)
+
+    def test_s3_settings_are_required_by_the_s3_backend_only(self):
+        """Test that s3_bucket and aws_region may be left out with the local storage backend"""
+        with tempfile.TemporaryDirectory() as root:
+            config = {'athena_database': 'db', 'storage_backend': 'local', 'storage_root': root}
+            TargetAthena(config=config)
+
+            with assert_raises(ConfigValidationError):
+                TargetAthena(config=dict(config, storage_backend='s3'))
+
+
+    def test_coerce_batch_follows_schema(self):
+        """Test that values are normalized to the types declared in the schema"""
+        schema = {
+            'properties': {
+                'id': {'type': 'integer'},
+                'updated_at': {'type': ['null', 'string'], 'format': 'date-time'},
+                'day': {'type': 'string', 'format': 'date'},
+                'price': {'type': ['null', 'number']},
+                'active': {'type': 'boolean'},
+                'name': {'type': 'string'},
+                'tags': {'type': 'array', 'items': {'type': 'integer'}},
+            }
+        }
+        records = [
+            {
+                'id': '1',
+                'updated_at': '2021-03-04T05:06:07.123456Z',
+                'day': '2021-03-04T00:00:00',
+                'price': '10.50',
+                'active': 'false',
+                'name': 'a',
+                'tags': ['1', 2],
+            },
+            {'id': 2, 'updated_at': None, 'name': 'b'},
+        ]
+        coercion.coerce_batch(records, coercion.compile_coercers(schema))
+
+        self.assertEqual(
+            {
+                'id': 1,
+                'updated_at': '2021-03-04 05:06:07.123',
+                'day': '2021-03-04',
+                'price': 10.5,
+                'active': False,
+                'name': 'a',
+                'tags': [1, 2],
+            },
+            records[0],
+        )
+        self.assertEqual({'id': 2, 'updated_at': None, 'name': 'b'}, records[1])
+
+
+    def test_adaptive_compression_level_finds_fastest_level(self):
+        """Test that the adaptive compression level settles on the fastest level"""
+        tuner = AdaptiveCompressionLevel(1, 9)
+        for _ in range(12):
+            records = 1000 - abs(tuner.level - 4) * 100
+            tuner.record(records, compress_seconds=0.5, upload_seconds=0.5)
+
+        self.assertEqual(4, tuner.level)
+
+
+    def test_retry_policy_retries_only_retriable_errors(self):
+        """Test that throttling errors are retried within the budget and others are raised"""
+        class FakeClientError(Exception):
+            def __init__(self, code, status):
+                super().__init__(code)
+                self.response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}
+
+        delays = []
+        policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=10, max_total_delay=1.5, sleep=delays.append)
+        calls = []
+
+        def throttled():
+            calls.append(1)
+            raise FakeClientError('SlowDown', 503)
+
+        with assert_raises(FakeClientError):
+            policy.call('put', throttled)
+        self.assertEqual(3, len(calls))
+        self.assertTrue(sum(delays) <= 1.5)
+        self.assertEqual({'attempts': 3, 'give_ups': 1, 'retries': 2}, policy.snapshot()['put'])
+
+        def forbidden():
+            raise FakeClientError('AccessDenied', 403)
+
+        before = policy.snapshot()
+        with assert_raises(FakeClientError):
+            policy.call('head', forbidden)
+        self.assertEqual({'attempts': 1}, policy.snapshot()['head'])
+        # Only the counters that grew since the snapshot are reported
+        self.assertEqual({'head': {'attempts': 1}}, policy.since(before))
+
+
+    def test_sort_records_spills_large_batches(self):
+        """Test that external sorting gives the same order as an in-memory sort"""
+        records = [{'id': i, 'group': (i * 7) % 5 or None} for i in range(50)]
+        expected = sorted(records, key=lambda r: (r['group'] is not None, r['group'] or 0, r['id']))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            in_memory = list(sort_records(list(records), ['group', 'id']))
+            to_spill = list(records)
+            spilled = list(sort_records(to_spill, ['group', 'id'], max_rows_in_memory=8, temp_dir=temp_dir))
+
+        self.assertEqual(expected, in_memory)
+        self.assertEqual(expected, spilled)
+        # The input list is released as its runs are spilled
+        self.assertEqual([], to_spill)
+
+
+    def test_sort_records_orders_mixed_types(self):
+        """Test that columns holding values of several types sort without raising"""
+        values = ['a', None, {'b': 1}, 2, True, [1], 1.5, 'B', {'a': 2}]
+        records = [{'v': value} for value in values]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            in_memory = [record['v'] for record in sort_records(list(records), ['v'])]
+            spilled = [record['v'] for record in sort_records(list(records), ['v'], max_rows_in_memory=2, temp_dir=temp_dir)]
+
+        self.assertEqual([None, True, 1.5, 2, 'B', 'a', [1], {'a': 2}, {'b': 1}], in_memory)
+        self.assertEqual(in_memory, spilled)
+
+
+    def test_memory_budget_scheduler_selects_sinks_by_policy(self):
+        """Test that sinks are drained largest or oldest first until under the low watermark"""
+        class FakeSink:
+            def __init__(self, buffered_bytes, buffered_since):
+                self.buffered_bytes = buffered_bytes
+                self.buffered_since = buffered_since
+
+        small_old, large_new, medium = FakeSink(10, 1.0), FakeSink(60, 3.0), FakeSink(40, 2.0)
+        sinks = [small_old, large_new, medium]
+
+        largest = MemoryBudgetScheduler(100, policy='largest')
+        largest.track(110)
+        self.assertEqual([large_new], largest.select(sinks))
+
+        oldest = MemoryBudgetScheduler(100, policy='oldest')
+        oldest.track(110)
+        self.assertEqual([small_old, medium], oldest.select(sinks))
+
+        oldest.release(110)
+        self.assertEqual([], oldest.select(sinks))
+
+
+    def test_hash_bucketing_matches_hive(self):
+        """Test that rows are bucketed like Hive's STRING hash and the DDL declares the buckets"""
+        self.assertEqual(97, hive_string_hash('a'))
+        self.assertEqual(31 * 97 + 98, hive_string_hash('ab'))
+        # Bytes above 127 are signed, as in Java
+        self.assertEqual((31 * -61 - 87) & 0xFFFFFFFF, hive_string_hash('é'))
+
+        self.assertEqual(3105 % 4, bucket_of({'id': 'ab'}, ['id'], 4))
+        self.assertEqual(ord('7') % 4, bucket_of({'id': 7}, ['id'], 4))
+        self.assertEqual(0, bucket_of({'id': None}, ['id'], 4))
+        self.assertEqual((31 * 97 + 98) % 8, bucket_of({'a': 'a', 'b': 'b'}, ['a', 'b'], 8))
+        # Values hash as the text written to the file: JSON literals, or str() in CSV
+        self.assertEqual(hive_string_hash('true') % 7, bucket_of({'f': True}, ['f'], 7))
+        self.assertEqual(hive_string_hash('True') % 7, bucket_of({'f': True}, ['f'], 7, 'csv'))
+        self.assertNotEqual(bucket_of({'f': True}, ['f'], 7), bucket_of({'f': True}, ['f'], 7, 'csv'))
+
+        ddl = target_athena.athena.generate_create_table_ddl(
+            'orders', {}, headers=['id', 'name'], database='db', data_location='s3://b/db/orders/',
+            bucket_by=['id'], bucket_count=4,
+        )
+        self.assertIn(')\nCLUSTERED BY (`id`) INTO 4 BUCKETS\nROW FORMAT', ddl)
+        self.assertIn('TBLPROPERTIES ("skip.header.line.count" = "1", "bucketing_version" = "1")', ddl)
+
+
+    def test_split_record_line_keeps_raw_record_text(self):
+        """Test that RECORD messages are split into the stream and the record text as received"""
+        record = '{"id": 1, "txt": "a } \\" ] {", "nested": {"list": [1, {"x": null}]}}'
+        line = '{"type": "RECORD", "stream": "orders", "record": ' + record + ', "time_extracted": "2021-01-01T00:00:00Z"}\n'
+        self.assertEqual(('orders', record), split_record_line(line))
+
+        # Envelope keys may come in any order
+        line = '{"record":' + record + ',"stream":"orders","type":"RECORD"}'
+        self.assertEqual(('orders', record), split_record_line(line))
+
+        self.assertIsNone(split_record_line('{"type": "STATE", "value": {"bookmarks": {}}}'))
+        self.assertIsNone(split_record_line('{"type": "RECORD", "stream": "orders", "record": [1]}'))
+        self.assertIsNone(split_record_line('{"type": "RECORD", "stream": "orders", "record": {"id": 1'))
+
+
+    def test_get_target_key_spreads_keys_over_shards(self):
+        """Test that sharded keys stay under the stream prefix and cover every shard"""
+        keys = [
+            target_athena.utils.get_target_key('orders', 'jsonl', prefix='db/', timestamp=f'20210101T{i:06d}', shards=16)
+            for i in range(200)
+        ]
+        for key in keys:
+            self.assertRegex(key, r'^db/orders/[0-9a-f]-20210101T\d{6}\.jsonl$')
+        self.assertEqual(16, len({key[len('db/orders/')] for key in keys}))
+        self.assertEqual(keys[0], target_athena.utils.get_target_key('orders', 'jsonl', prefix='db/', timestamp='20210101T000000', shards=16))
+
+        # Shards are zero padded to the width of the largest one
+        self.assertEqual(3, len(target_athena.utils.key_shard('orders/20210101T000000', 4096)))
+
+
+    def test_backfill_reads_schema_messages_and_expands_globs(self):
+        """Test that backfill inputs are resolved from globs and schemas from SCHEMA messages"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name in ('a/1.jsonl', 'a/2.jsonl.gz', 'b/3.jsonl'):
+                os.makedirs(os.path.dirname(os.path.join(temp_dir, name)), exist_ok=True)
+                open(os.path.join(temp_dir, name), 'w').close()
+            schema_path = os.path.join(temp_dir, 'schema.json')
+            with open(schema_path, 'w') as schema_file:
+                schema_file.write('{"type": "SCHEMA", "stream": "s", "schema": {"properties": {}}, "key_properties": ["id"]}')
+
+            paths = expand_inputs([os.path.join(temp_dir, '**', '*.jsonl*'), os.path.join(temp_dir, 'a', '*')])
+
+            self.assertEqual(
+                [os.path.join(temp_dir, name) for name in ('a/1.jsonl', 'a/2.jsonl.gz', 'b/3.jsonl')],
+                paths,
+            )
+            self.assertEqual(({'properties': {}}, ['id']), load_schema(schema_path))
+            self.assertEqual(({'properties': {}}, ['other']), load_schema(schema_path, ['other']))
+
+
+        self.assertTrue(is_singer_message('{"type": "SCHEMA", "stream": "s", "schema": {}, "key_properties": []}'))
+        self.assertTrue(is_singer_message('{"type": "STATE", "value": {"bookmarks": {}}}'))
+        self.assertTrue(is_singer_message('{"type": "ACTIVATE_VERSION", "stream": "s", "version": 1}'))
+        # Records that merely have a `type` field are loaded
+        self.assertFalse(is_singer_message('{"id": 1, "type": "STATE"}'))
+        self.assertFalse(is_singer_message('{"type": "RECORD", "stream": "s", "record": {}}'))
+
+
+    def test_csv_writer_writes_columns_in_order_with_escaped_newlines(self):
+        """Test that the CSV writer follows its columns, escapes newlines and writes the header once"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, 'out.csv')
+            writer = CSVWriter(['id', 'txt', 'missing'], delimiter='|')
+            writer.CHUNK_SIZE = 2
+
+            self.assertEqual(0, writer.write(filename, []))
+            self.assertFalse(os.path.exists(filename))
+
+            records = [{'txt': 'a\nb', 'id': 1}, {'id': 2, 'txt': None}, {'id': 3, 'txt': 'x|y', 'extra': 1}]
+            self.assertEqual(3, writer.write(filename, iter(records)))
+            self.assertEqual(1, writer.write(filename, [{'id': 4}]))
+
+            with open(filename) as csv_file:
+                self.assertEqual('id|txt|missing\n1|a\\nb|\n2||\n3|"x|y"|\n4||\n', csv_file.read())
+            self.assertEqual('a\nb', records[0]['txt'])
+
+
+    def test_batch_profiler_writes_loadable_profiles(self):
+        """Test that sampled batches write per-stage cProfile stats and a memory report"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            profiler = BatchProfiler('orders', directory=temp_dir, every_n_batches=2)
+            for _ in range(3):
+                with profiler.batch() as profile:
+                    with profile.stage('prepare'):
+                        sorted(range(1000), reverse=True)
+                    with profile.stage('write'):
+                        [str(i) for i in range(1000)]
+
+            prefix = os.path.join(temp_dir, f'orders-{os.getpid()}-')
+            self.assertEqual(
+                sorted(f'{prefix}{batch}{suffix}' for batch in ('000001', '000003')
+                       for suffix in ('.prof', '-prepare.prof', '-write.prof', '-memory.txt')),
+                sorted(os.path.join(temp_dir, name) for name in os.listdir(temp_dir)),
+            )
+            for name in ('000001.prof', '000001-prepare.prof', '000003-write.prof'):
+                self.assertTrue(pstats.Stats(prefix + name).total_calls > 0)
+            with open(prefix + '000001-memory.txt') as report:
+                self.assertTrue(report.readline().startswith('Peak traced memory:'))
+
+
+    def test_flatten_schema_columns_match_flattened_records(self):
+        """Test that the flattened schema columns are the keys of flattened records, in order"""
+        properties = {
+            'name': {'type': ['null', 'string']},
+            'meta': {'type': ['null', 'object'], 'properties': {'b': {'type': 'string'}, 'a': {'type': 'integer'}}},
+            'id': {'type': 'integer'},
+            'extra': {'type': 'object'},
+        }
+        record = {'name': 'x', 'meta': {'a': 1, 'b': 'y'}, 'id': 1, 'extra': None}
+
+        columns = target_athena.utils.flatten_schema_columns(properties)
+
+        self.assertEqual(['extra', 'id', 'meta__a', 'meta__b', 'name'], columns)
+        self.assertEqual(columns, list(target_athena.utils.flatten_record(record, schema=properties)))
+        # Objects without declared properties stay one column, as JSON text
+        flattened = target_athena.utils.flatten_record(dict(record, extra={'k': 1}), schema=properties)
+        self.assertEqual(columns, list(flattened))
+        self.assertEqual('{"k": 1}', flattened['extra'])